@@ -0,0 +1,129 @@
+"""Caches that are persisted to S3 and shared between report runs."""
+
+import json
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__file__)
+
+_persistent_caches = {}
+_persistent_caches_lock = threading.Lock()
+
+
+class PersistentCache:
+    """Key/value cache stored as a single JSON object in the report bucket.
+
+    Keys are tuples of strings. Entries holding a truthy value expire `ttl` seconds after
+    they were set (or last hit, with `refresh_on_hit`), entries holding a falsy value
+    (negative entries) expire `negative_ttl` seconds after they were set. A TTL of None
+    never expires.
+
+    A cache whose stored content could not be read is used empty but never saved, so that
+    it does not overwrite the entries of the other runs.
+    """
+
+    def __init__(self, name, ttl=None, negative_ttl=None, s3=None, refresh_on_hit=False):
+        """Init method for the PersistentCache class."""
+        self.name = name
+        self.obj_key = 'cache/{name}.json'.format(name=name)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.s3 = s3
+        self.refresh_on_hit = refresh_on_hit
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+        self.load_failed = False
+        self.dirty = False
+
+    def is_expired(self, value, updated_at, now):
+        """Check whether an entry is older than the TTL that applies to its value."""
+        ttl = self.ttl if value else self.negative_ttl
+        return ttl is not None and now - updated_at > ttl
+
+    def load(self):
+        """Load the cache content from S3, dropping the expired entries."""
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.s3 is None:
+            return
+        try:
+            with self.s3.open_json_object(bucket_name=self.s3.report_bucket_name,
+                                          obj_key=self.obj_key) as body:
+                content = json.load(body) or {}
+        except Exception as e:
+            # A missing cache only costs extra lookups, it must not fail the report
+            content = {}
+            if not (isinstance(e, ClientError) and
+                    e.response['Error']['Code'] == 'NoSuchKey'):
+                logger.error('Unable to load the {name} cache, it is not saved. '
+                             'Reason: %r'.format(name=self.name) % e)
+                self.load_failed = True
+        now = time.time()
+        for key, value, updated_at in content.get('entries', []):
+            if not self.is_expired(value, updated_at, now):
+                self.entries[tuple(key)] = (value, updated_at)
+        logger.info('Loaded {n} entries into the {name} cache'.format(
+            n=len(self.entries), name=self.name))
+
+    def get(self, key, default=None):
+        """Return the cached value for the key, or default on a miss."""
+        self.load()
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None or self.is_expired(entry[0], entry[1], now):
+            self.misses += 1
+            return default
+        self.hits += 1
+        if entry[0] and self.refresh_on_hit:
+            # Keep frequently used positive entries alive
+            self.entries[key] = (entry[0], now)
+            self.dirty = True
+        return entry[0]
+
+    def set(self, key, value):
+        """Store the value for the key."""
+        self.load()
+        self.entries[key] = (value, time.time())
+        self.dirty = True
+
+    def log_stats(self):
+        """Log the hit/miss counts of the cache."""
+        logger.info('{name} cache: {hits} hits, {misses} misses'.format(
+            name=self.name, hits=self.hits, misses=self.misses))
+
+    def save(self):
+        """Store the cache content back to S3 if it changed."""
+        if not self.dirty or self.s3 is None or self.load_failed:
+            return
+        content = {
+            'entries': [[list(key), value, updated_at]
+                        for key, (value, updated_at) in self.entries.items()]
+        }
+        self.s3.store_json_content(content=content, bucket_name=self.s3.report_bucket_name,
+                                   obj_key=self.obj_key)
+        self.dirty = False
+
+
+def get_persistent_cache(name, ttl=None, negative_ttl=None, s3=None, refresh_on_hit=False):
+    """Get the cache shared by all the helpers of the process, creating it on first use.
+
+    Each instance saves its whole content, so two instances of the same cache would
+    overwrite each other's entries. The cache keeps the S3 helper of the first caller.
+
+    :raises ValueError: when the cache is already used with other expiry settings
+    """
+    with _persistent_caches_lock:
+        cache = _persistent_caches.get(name)
+        if cache is None:
+            cache = PersistentCache(name, ttl, negative_ttl, s3, refresh_on_hit)
+            _persistent_caches[name] = cache
+        elif (cache.ttl, cache.negative_ttl, cache.refresh_on_hit) != \
+                (ttl, negative_ttl, refresh_on_hit):
+            raise ValueError('The {name} cache is already used with other settings'.format(
+                name=name))
+        return cache
@@ -3,24 +3,96 @@ import requests
 import time
 import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from datetime import timedelta
-from graph_report_generator import get_session_retry, GREMLIN_SERVER_URL_REST
+from requests.adapters import HTTPAdapter
+from cache_helper import PersistentCache
+from graph_report_generator import find_cves_in_graph
 
 logger = logging.getLogger(__file__)
 
+GITHUB_SEARCH_WORKERS = int(os.getenv('GITHUB_SEARCH_WORKERS', 6))
+GITHUB_TIMEOUT = float(os.getenv('GITHUB_TIMEOUT', 60))
+# Longest wait for the GitHub rate limit to reset before a CVE report is given up
+GITHUB_RATE_LIMIT_MAX_WAIT = int(os.getenv('GITHUB_RATE_LIMIT_MAX_WAIT', 3600))
+
+# Calls with a higher priority value leave that many calls of the quota to the others
+PRIORITY_INGESTION = 0
+PRIORITY_FALSE_POSITIVES = 1
+PRIORITY_OPEN_COUNT = 2
+
+_github_session = None
+_github_session_lock = threading.Lock()
+
+
+def get_github_session():
+    """Get the pooled session shared by all the GitHub API calls."""
+    global _github_session
+    with _github_session_lock:
+        if _github_session is None:
+            _github_session = requests.Session()
+            _github_session.mount('https://', HTTPAdapter(pool_maxsize=GITHUB_SEARCH_WORKERS))
+    return _github_session
+
+
+class GitHubRateLimited(Exception):
+    """The GitHub rate limit does not allow the call until it resets."""
+
+
+class GitHubRateLimiter:
+    """Token bucket shared by all the GitHub calls, refilled from the X-RateLimit-* headers."""
+
+    def __init__(self):
+        """Init method for the GitHubRateLimiter class."""
+        self.remaining = None
+        self.reset = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, priority=0):
+        """Take a token for a call, keeping `priority` tokens for more important calls."""
+        with self.lock:
+            if self.remaining is None or time.time() >= self.reset:
+                return True
+            if self.remaining > priority:
+                self.remaining -= 1
+                return True
+            return False
+
+    def update(self, headers):
+        """Update the bucket from the rate limit headers of a response."""
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self.lock:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset = int(headers.get('X-RateLimit-Reset', 0))
+
+    def wait_time(self):
+        """Return the seconds left until the rate limit resets."""
+        with self.lock:
+            return max(0, self.reset - time.time())
+
+
+github_rate_limiter = GitHubRateLimiter()
+
 
 class CVE(object):
     """CVE class helper to validate and generate CVE report."""
 
-    def __init__(self):
-        """Initialise CVE class."""
+    def __init__(self, etag_cache=None):
+        """Initialise CVE class.
+
+        :param etag_cache: PersistentCache, GitHub responses and their ETags keyed by URL
+        """
+        self.etag_cache = etag_cache if etag_cache is not None else PersistentCache('github-etags')
+        self.etag_lock = threading.Lock()
+        # Set when the rate limit held back some of the open CVE counts
+        self.open_counts_deferred = False
         self.repo_name = os.environ.get('GITHUB_CVE_REPO', 'fabric8-analytics')
         self.github_url = 'https://api.github.com/search/issues?q=repo:{}/cvedb'.format(
             self.repo_name
         )
-        self.github_rate_limits = 100
-        self.github_rate_limit_reset = -1
 
     def get_cveids_from_cvedb_prs(self, updated_on):
         """Get all the merged CVEDB Pull Requests."""
@@ -31,7 +103,7 @@ class CVE(object):
             query = '+type:pr+is:merged+updated:{}&sort=updated&order=desc&per_page=100'.format(
                 updated_on
             )
-            cve_json = self.call_github_api(query=query)
+            cve_json = self.call_github_api(query=query, priority=PRIORITY_INGESTION)
             for cve in cve_json.get('items'):
                 # Get the CVE ID from the title of the PR
                 title = cve.get('title', '')
@@ -54,25 +126,15 @@ class CVE(object):
         assert isinstance(cve_ids, list)
         # Check whether CVE node is present in graph or not
         try:
+            present, unchecked = find_cves_in_graph(cve_ids)
+            if unchecked:
+                logger.error("Error - CVEGraphValidation failed for CVEs: {}".format(unchecked))
+            unchecked = set(unchecked)
             for cve_id in cve_ids:
-                gremlin_query = "g.V().has('cve_id', '{}').valueMap();".format(cve_id)
-                payload = {'gremlin': gremlin_query}
-                try:
-                    resp = get_session_retry().post(url=GREMLIN_SERVER_URL_REST, json=payload)
-                    if resp.status_code == 200:
-                        graph_resp = resp.json()
-                        if graph_resp.get('result', {}).get('data', []):
-                            ingested.append(cve_id)
-                        else:
-                            missed.append(cve_id)
-                    else:
-                        msg = "Error - CVEGraphValidation failed for CVE: {} with error: {}".format(
-                                cve_id, resp.status_code)
-                        logger.error(msg)
-                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
-                        requests.exceptions.RequestException) as e:
-                    logger.error('Error Connecting to Graph Instance : %r' % e)
-                    continue
+                if cve_id in present:
+                    ingested.append(cve_id)
+                elif cve_id not in unchecked:
+                    missed.append(cve_id)
 
             return ingested, missed
 
@@ -84,27 +146,42 @@ class CVE(object):
         try:
             # Create a query to fetch False Positive PRs closed yesterday
             query = '+type:pr+is:closed+updated:{}'.format(updated_on)
-            cve_json = self.call_github_api(query=query)
+            cve_json = self.call_github_api(query=query, priority=PRIORITY_FALSE_POSITIVES)
             return cve_json.get('total_count', -1)
 
         except (ValueError, TypeError) as e:
             raise ValueError('%r' % e)
 
-    def call_github_api(self, query):
-        """Return the json output from Github APIs."""
-        # Check if we are above github rate limits
-        # If yes, wait till the limit is reset
-        if self.github_rate_limits <= 1 and self.github_rate_limit_reset > 0:
-            wait_time = self.github_rate_limit_reset - int(dt.now().timestamp())
-            logger.info("Github Rate Limits Exceeded. Waiting for {} seconds".format(wait_time))
-            time.sleep(wait_time)
+    def call_github_api(self, query, priority=PRIORITY_INGESTION):
+        """Return the json output from Github APIs.
+
+        Raises GitHubRateLimited instead of waiting when the rate limit is exhausted.
+        """
+        url = self.github_url + query
+        headers = {"Accept": "application/vnd.github.symmetra-preview+json"}
+        with self.etag_lock:
+            cached = self.etag_cache.get((url,))
+        # GitHub does not count a 304 Not Modified against the rate limit,
+        # so conditional requests do not take a token
+        if cached:
+            headers['If-None-Match'] = cached['etag']
+        elif not github_rate_limiter.acquire(priority):
+            raise GitHubRateLimited("Github Rate Limits Exceeded for query: {}".format(query))
         try:
-            resp = requests.get(url=self.github_url + query,
-                                headers={"Accept": "application/vnd.github.symmetra-preview+json"})
-            self.github_rate_limits = int(resp.headers.get('X-RateLimit-Remaining', 0))
-            self.github_rate_limit_reset = int(resp.headers.get('X-RateLimit-Reset', -1))
+            resp = get_github_session().get(url=url, headers=headers, timeout=GITHUB_TIMEOUT)
+            github_rate_limiter.update(resp.headers)
+            if resp.status_code in (403, 429) and \
+                    resp.headers.get('X-RateLimit-Remaining') in (0, '0'):
+                raise GitHubRateLimited("Github Rate Limits Exceeded for query: {}".format(query))
+            if resp.status_code == 304 and cached:
+                return cached['body']
 
-            return resp.json() or None
+            body = resp.json() or None
+            etag = resp.headers.get('ETag')
+            if resp.status_code == 200 and body and etag:
+                with self.etag_lock:
+                    self.etag_cache.set((url,), {'etag': etag, 'body': body})
+            return body
 
         except (ValueError, requests.exceptions.ConnectionError,
                 requests.exceptions.Timeout, requests.exceptions.RequestException) as e:
@@ -112,21 +189,34 @@ class CVE(object):
             raise ValueError('%r' % e)
 
     def get_open_cves_count(self, updated_on):
-        """Get all the open CVE count for the last [2, 7, 30, 365] days."""
+        """Get all the open CVE count for the last [2, 7, 30, 365] days.
+
+        The counts the rate limit holds back are left out and flag open_counts_deferred.
+        """
+        self.open_counts_deferred = False
         cve_stats = {"github_stats": {"open_count": {}}}
         end_date = (dt.strptime(updated_on, "%Y-%m-%d") - timedelta(days=1)).strftime(
                     "%Y-%m-%d")
         # Create a query to fetch PRs not acted for more than xx days
+        queries = {}
         for day in [2, 7, 30, 365]:
-            open_key = str(day) + " days"
             start_date = (dt.strptime(updated_on, "%Y-%m-%d") - timedelta(days=day)).strftime(
                 "%Y-%m-%d")
-            query = '+type:pr+is:open+created:{}..{}'.format(start_date, end_date)
+            queries[str(day) + " days"] = '+type:pr+is:open+created:{}..{}'.format(
+                start_date, end_date)
+        with ThreadPoolExecutor(max_workers=GITHUB_SEARCH_WORKERS) as executor:
+            futures = {open_key: executor.submit(self.call_github_api, query=query,
+                                                 priority=PRIORITY_OPEN_COUNT)
+                       for open_key, query in queries.items()}
+        for open_key, future in futures.items():
             try:
-                cve_json = self.call_github_api(query=query)
+                cve_json = future.result()
                 if cve_json and isinstance(cve_json, dict):
                     cve_stats['github_stats']['open_count'][open_key] = \
                         cve_json.get('total_count', -1)
+            except GitHubRateLimited as e:
+                logger.info('%r' % e)
+                self.open_counts_deferred = True
             except (ValueError, TypeError) as e:
                 logger.error('%r' % e)
                 continue
@@ -136,14 +226,20 @@ class CVE(object):
         """Generate CVE statistics and CVE ingestion report."""
         try:
             assert dt.strptime(updated_on, "%Y-%m-%d")
+            # The GitHub searches of the report are independent of each other
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                open_counts = executor.submit(self.get_open_cves_count, updated_on)
+                fp_count = executor.submit(self.get_fp_cves_count, updated_on)
+                cve_ids = executor.submit(self.get_cveids_from_cvedb_prs, updated_on)
+
             # Add Open Count of CVEs for the last 2 days, week, month and year
-            cve_report = self.get_open_cves_count(updated_on)
+            cve_report = open_counts.result()
 
             # Add false positives PRs from yesterday
-            cve_report['github_stats']['false_positives'] = self.get_fp_cves_count(updated_on)
+            cve_report['github_stats']['false_positives'] = fp_count.result()
 
             # Create CVE Ingestion Report
-            cves_from_github = self.get_cveids_from_cvedb_prs(updated_on)
+            cves_from_github = cve_ids.result()
             ingested_cves, missed_cves = self.validate_cveids_in_graph(cves_from_github)
             cve_report['ingestion'] = {'ingested': ingested_cves, 'missed': missed_cves}
 
@@ -152,3 +248,127 @@ class CVE(object):
         except (ValueError, TypeError, AssertionError) as e:
             logger.error('%r' % e)
             return None
+
+
+class CVEReportProvider:
+    """Generate the CVE report once per day and share it between the report builders.
+
+    A report held back by the GitHub rate limit is generated in the background once the
+    limit resets, the callbacks registered with when_ready then fill it into the reports.
+    A report missing only its open CVE counts is returned at once and completed the same way.
+    """
+
+    def __init__(self):
+        """Init method for the CVEReportProvider class."""
+        self.reports = {}
+        self.pending = {}
+        self.futures = {}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def generate(self, updated_on, cache=None, etag_cache=None):
+        """Generate the CVE report for the day and store it in the cache.
+
+        :return tuple, the report and whether the rate limit held back its open counts
+        """
+        cve = CVE(etag_cache)
+        try:
+            report = cve.generate_cve_report(updated_on=updated_on)
+        finally:
+            if etag_cache is not None:
+                etag_cache.save()
+        # An incomplete report is not stored, a retried run generates it again
+        if report is not None and cache is not None and not cve.open_counts_deferred:
+            cache.set((updated_on,), report)
+            cache.save()
+        return report, cve.open_counts_deferred
+
+    def defer(self, updated_on, cache, etag_cache):
+        """Generate the report of the day in the background once the rate limit resets."""
+        self.pending[updated_on] = []
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures[updated_on] = self.executor.submit(
+            self.generate_when_reset, updated_on, cache, etag_cache)
+
+    def get_report(self, updated_on, cache=None, etag_cache=None):
+        """Return the CVE report for the day, generating it only on the first request.
+
+        :param updated_on: str, day of the report in YYYY-MM-DD format
+        :param cache: PersistentCache, reports generated by earlier runs
+        :param etag_cache: PersistentCache, GitHub responses and their ETags keyed by URL
+        :return dict, CVE report or None when it could not be generated yet
+        """
+        with self.lock:
+            if updated_on in self.reports:
+                return self.reports[updated_on]
+            if updated_on in self.pending:
+                return None
+            report = cache.get((updated_on,)) if cache is not None else None
+            if report is None:
+                try:
+                    report, deferred = self.generate(updated_on, cache, etag_cache)
+                except GitHubRateLimited as e:
+                    logger.info('%r, the CVE report for %s is generated once it resets'
+                                % (e, updated_on))
+                    self.defer(updated_on, cache, etag_cache)
+                    return None
+                if deferred:
+                    logger.info('The open CVE counts for %s are filled in once the GitHub '
+                                'rate limit resets' % updated_on)
+                    self.defer(updated_on, cache, etag_cache)
+            # A failed report is generated again on the next request
+            if report is not None:
+                self.reports[updated_on] = report
+            return report
+
+    def generate_when_reset(self, updated_on, cache, etag_cache):
+        """Wait for the GitHub rate limit to reset and generate the CVE report.
+
+        The searches answered before are sent again as conditional requests, which do not
+        count against the rate limit.
+        """
+        wait_time = github_rate_limiter.wait_time()
+        if wait_time > GITHUB_RATE_LIMIT_MAX_WAIT:
+            logger.error('GitHub rate limit resets in {s} seconds, giving up the CVE report '
+                         'for {day}'.format(s=int(wait_time), day=updated_on))
+            return None
+        time.sleep(wait_time)
+        try:
+            report, _ = self.generate(updated_on, cache, etag_cache)
+            return report
+        except GitHubRateLimited as e:
+            logger.error('%r' % e)
+            return None
+
+    def when_ready(self, updated_on, callback):
+        """Register a callback filling in the report of the day once it is generated.
+
+        :return bool, whether the report of the day, or a part of it, is held back by the
+            rate limit
+        """
+        with self.lock:
+            if updated_on not in self.pending:
+                return False
+            self.pending[updated_on].append(callback)
+            return True
+
+    def wait(self):
+        """Wait for the held back reports and pass them to the registered callbacks."""
+        for updated_on, future in list(self.futures.items()):
+            report = future.result()
+            with self.lock:
+                callbacks = self.pending.pop(updated_on, [])
+                del self.futures[updated_on]
+                if report is not None:
+                    self.reports[updated_on] = report
+            if report is None:
+                continue
+            for callback in callbacks:
+                callback(report)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+cve_report_provider = CVEReportProvider()
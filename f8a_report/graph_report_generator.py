@@ -1,12 +1,16 @@
 """Helper functions related to to generate ingestion reports."""
 
 from f8a_utils.versions import get_latest_versions_for_ep
+import itertools
 import logging
 import os
+import threading
 import requests
+import time
 import traceback
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 _logger = logging.getLogger(__name__)
@@ -17,6 +21,16 @@ GREMLIN_SERVER_URL_REST = "http://{host}:{port}".format(
     port=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_PORT", "8182"))
 
 GREMLIN_QUERY_SIZE = int(os.getenv('GREMLIN_QUERY_SIZE', 25))
+GREMLIN_QUERY_SIZE_MIN = int(os.getenv('GREMLIN_QUERY_SIZE_MIN', 5))
+GREMLIN_QUERY_SIZE_MAX = int(os.getenv('GREMLIN_QUERY_SIZE_MAX', 200))
+GREMLIN_QUERY_SIZE_STEP = int(os.getenv('GREMLIN_QUERY_SIZE_STEP', 5))
+GREMLIN_QUERY_TARGET_SECONDS = float(os.getenv('GREMLIN_QUERY_TARGET_SECONDS', 10))
+GREMLIN_RETRIES = int(os.getenv('GREMLIN_RETRIES', 2))
+GREMLIN_TIMEOUT = float(os.getenv('GREMLIN_TIMEOUT', 120))
+GREMLIN_CVE_QUERY_SIZE = int(os.getenv('GREMLIN_CVE_QUERY_SIZE', 100))
+
+UPSTREAM_LOOKUP_WORKERS = int(os.getenv('UPSTREAM_LOOKUP_WORKERS', 16))
+UPSTREAM_LOOKUP_ECOSYSTEM_WORKERS = int(os.getenv('UPSTREAM_LOOKUP_ECOSYSTEM_WORKERS', 4))
 
 _SERVICE_HOST = os.environ.get("BAYESIAN_DATA_IMPORTER_SERVICE_HOST", "bayesian-data-importer")
 _SERVICE_PORT = os.environ.get("BAYESIAN_DATA_IMPORTER_SERVICE_PORT", "9192")
@@ -24,12 +38,26 @@ _SYNC_ENDPOINT = "api/v1/sync_latest_version"
 _SYNC_API_URL = "http://{host}:{port}/{endpoint}".format(host=_SERVICE_HOST,
                                                          port=_SERVICE_PORT,
                                                          endpoint=_SYNC_ENDPOINT)
+SYNC_CHUNK_SIZE = int(os.getenv('SYNC_LATEST_VERSION_CHUNK_SIZE', 500))
+SYNC_WORKERS = int(os.getenv('SYNC_LATEST_VERSION_WORKERS', 4))
+SYNC_TIMEOUT = int(os.getenv('SYNC_LATEST_VERSION_TIMEOUT', 1800))
+
+
+class Deadline:
+    """Time budget shared by all the graph lookups of a run."""
+
+    def __init__(self, seconds=None):
+        """Init method for the Deadline class, None means no budget."""
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def expired(self):
+        """Check whether the budget has run out."""
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
 
 
-def rectify_latest_version(incorrect_list, eco, stack_flow=False):
-    """Rectify the latest version in graph."""
+def build_sync_deps(incorrect_list, eco, stack_flow=False):
+    """Build the sync_latest_version payload for the packages of an ecosystem."""
     deps = []
-    _logger.info("Function called to rectify the latest version.Stack-Flow={}".format(stack_flow))
     for incorrect_data in incorrect_list:
         if stack_flow:
             pkg = incorrect_data.split(" ")[0]
@@ -44,22 +72,104 @@ def rectify_latest_version(incorrect_list, eco, stack_flow=False):
                 "actual_latest_version": incorrect_data['actual_latest_version']
             }
         deps.append(tmp)
+    return deps
 
+
+def post_sync_request(deps, eco):
+    """Call the sync_latest_version API, return whether the call succeeded."""
     try:
-        _logger.info("Calling sync_latest_version API for the ecosystem {}".format(eco))
-        resp = requests.post(_SYNC_API_URL, json=deps, timeout=1800)
+        _logger.info("Calling sync_latest_version API for {n} packages of the ecosystem {e}"
+                     .format(n=len(deps), e=eco))
+        resp = requests.post(_SYNC_API_URL, json=deps, timeout=SYNC_TIMEOUT)
         _logger.info("Response for the sync_latest_version API call.........")
         _logger.info(resp.json())
-        return "Success"
+        return True
     except Exception:
         _logger.error(traceback.format_exc())
+        return False
+
+
+class LatestVersionSync:
+    """Submit latest version sync requests in the background.
+
+    Packages are deduplicated over the whole run and posted to the data importer in
+    chunks on a small thread pool, so that report generation does not wait for the
+    answers. `wait` collects the outcome at the end of the job.
+    """
+
+    def __init__(self, chunk_size=SYNC_CHUNK_SIZE, workers=SYNC_WORKERS):
+        """Init method for the LatestVersionSync class."""
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.executor = None
+        self.submitted = set()
+        self.futures = []
+
+    def submit(self, incorrect_list, eco, stack_flow=False, sync_cache=None):
+        """Queue the packages not yet submitted during this run for a sync.
+
+        With a sync_cache, stack packages already synced within the cache TTL are
+        skipped, and successfully synced ones are recorded in it by `wait`.
+        """
+        _logger.info("Function called to rectify the latest version.Stack-Flow={}".format(
+            stack_flow))
+        deps = []
+        skipped = 0
+        for dep in build_sync_deps(incorrect_list, eco, stack_flow):
+            key = (dep['ecosystem'], dep['name'])
+            if key in self.submitted:
+                continue
+            # Incorrect latest versions are always resent, they are not fixed yet
+            if stack_flow and sync_cache is not None and sync_cache.get(key):
+                skipped += 1
+                continue
+            self.submitted.add(key)
+            deps.append(dep)
+        if skipped:
+            _logger.info("Skipped {n} {e} packages synced recently".format(n=skipped, e=eco))
+        if not deps:
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        for start in range(0, len(deps), self.chunk_size):
+            chunk = deps[start:start + self.chunk_size]
+            cache = sync_cache if stack_flow else None
+            self.futures.append((eco, chunk, cache,
+                                 self.executor.submit(post_sync_request, chunk, eco)))
+
+    def wait(self):
+        """Wait for the submitted chunks and return the sync status per ecosystem."""
+        status = {}
+        caches = []
+        for eco, chunk, cache, future in self.futures:
+            eco_status = status.setdefault(eco, {'synced': 0, 'failed': 0})
+            if not future.result():
+                eco_status['failed'] += len(chunk)
+                continue
+            eco_status['synced'] += len(chunk)
+            if cache is not None:
+                for dep in chunk:
+                    cache.set((dep['ecosystem'], dep['name']), True)
+                if cache not in caches:
+                    caches.append(cache)
+        for cache in caches:
+            cache.save()
+        self.futures = []
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        _logger.info("Latest version sync status: {}".format(status))
+        return status
+
+
+latest_version_sync = LatestVersionSync()
 
 
 def generate_report_for_cves(cve_data):
     """Generate a report for CVEs.
 
     :param cve_data: list, list of CVEs
-    :return json, list of cve information
+    :return dict, status keyed by (cve_id, name, version) tuples
     """
     query_str = "g.V().has('cecosystem', '{arg0}')." \
                 "has('cve_id', '{arg1}').as('a').in('has_cve').as('b')." \
@@ -76,15 +186,14 @@ def generate_report_for_cves(cve_data):
         for pkg in v['packages']:
             name = pkg['name']
             for ver in pkg['versions']:
-                key = k + "@DELIM@" + name + "@DELIM@" + ver
-                report_result[key] = "Not Found"
-    result_data = batch_query_executor(query_str, args)
+                report_result[(k, name, ver)] = "Not Found"
+    result_data = batch_query_executor(query_str, args, 'cve')
     if result_data is not None:
         for res in result_data:
             id = get_value(res['a'], 'cve_id') if 'a' in res else ""
             pkg = get_value(res['b'], 'pname') if 'b' in res else ""
             ver = get_value(res['b'], 'version') if 'b' in res else ""
-            key = id + "@DELIM@" + pkg + "@DELIM@" + ver
+            key = (id, pkg, ver)
             if key in report_result:
                 report_result[key] = "Found"
             else:
@@ -92,75 +201,183 @@ def generate_report_for_cves(cve_data):
     return report_result
 
 
-def generate_report_for_unknown_epvs(epv_list):
-    """Generate a report for the unknown EPVs.
+def find_cves_in_graph(cve_ids, chunk_size=GREMLIN_CVE_QUERY_SIZE):
+    """Find which of the CVE ids have a node in the graph.
 
-    :param epv_list: list, list of EPVs
-    :return json, list of epv information
+    :param cve_ids: list, list of CVE ids
+    :param chunk_size: int, number of CVE ids checked by a single gremlin query
+    :return tuple, set of CVE ids present in the graph and list of CVE ids
+        not checked because of a graph failure
+    """
+    query_str = "g.V().has('cve_id', within(cve_ids)).values('cve_id').dedup();"
+    cve_ids = list(dict.fromkeys(cve_ids))
+    present = set()
+    unchecked = []
+    for start in range(0, len(cve_ids), chunk_size):
+        chunk = cve_ids[start:start + chunk_size]
+        payload = {'gremlin': query_str, 'bindings': {'cve_ids': chunk}}
+        gremlin_response = execute_gremlin_dsl(payload)
+        if gremlin_response is None:
+            unchecked.extend(chunk)
+            continue
+        present.update(get_response_data(gremlin_response, []))
+    return present, unchecked
+
+
+def find_epvs_in_graph(epv_keys, epv_cache=None, deadline=None):
+    """Find which of the EPVs are present in the graph.
+
+    EPVs found in the cache are not queried again, the outcome of the graph
+    lookup for the rest of them is stored back into the cache.
+
+    :param epv_keys: list, list of (ecosystem, name, version) tuples, may contain duplicates
+    :param epv_cache: PersistentCache, cache of EPV existence in the graph
+    :param deadline: Deadline, time budget for the graph queries
+    :return tuple, sets of (ecosystem, name, version) tuples present in the graph
+        and not checked because of a graph failure or an expired deadline
     """
     query_str = "g.V().has('pecosystem', '{arg0}')." \
                 "has('pname', '{arg1}').has('version', '{arg2}')" \
                 ".valueMap().dedup().fill(epv);"
-    report_result = {}
+    present = set()
+    queried = []
     args = []
+    # Query every distinct EPV only once, however often it was analysed
+    for key in dict.fromkeys(epv_keys):
+        cached = epv_cache.get(key) if epv_cache is not None else None
+        if cached is None:
+            queried.append(key)
+            args.append({
+                "0": key[0],
+                "1": key[1],
+                "2": key[2]
+            })
+        elif cached:
+            present.add(key)
+
+    unchecked_args = []
+    result_data = batch_query_executor(query_str, args, 'epv', deadline, unchecked_args)
+    if result_data is not None:
+        for res in result_data:
+            present.add((get_value(res, 'pecosystem'), get_value(res, 'pname'),
+                         get_value(res, 'version')))
+    unchecked = {(arg['0'], arg['1'], arg['2']) for arg in unchecked_args}
+
+    if epv_cache is not None:
+        for key in queried:
+            if key not in unchecked:
+                epv_cache.set(key, key in present)
+        epv_cache.log_stats()
+    return present, unchecked
+
+
+def generate_report_for_unknown_epvs(epv_list, epv_cache=None, deadline=None):
+    """Generate a report for the unknown EPVs.
+
+    :param epv_list: list, list of EPVs
+    :param epv_cache: PersistentCache, cache of EPV existence in the graph
+    :param deadline: Deadline, time budget for the graph queries
+    :return dict, graph status keyed by (ecosystem, name, version) tuples
+    """
+    report_result = {}
+    epv_keys = []
     for epv in epv_list:
         eco = epv['ecosystem']
         pkg = epv['name']
         ver = epv['version']
-        args.append({
-            "0": eco,
-            "1": pkg,
-            "2": ver
-        })
-        report_result[eco + "@DELIM@" + pkg + "@DELIM@" + ver] = "false"
-
-    result_data = batch_query_executor(query_str, args)
-    if result_data is not None:
-        for res in result_data:
-            eco = get_value(res, 'pecosystem')
-            pkg = get_value(res, 'pname')
-            ver = get_value(res, 'version')
-            report_result[eco + "@DELIM@" + pkg + "@DELIM@" + ver] = "true"
+        epv_keys.append((eco, pkg, ver))
+        report_result[(eco, pkg, ver)] = "false"
+
+    present, unchecked = find_epvs_in_graph(epv_keys, epv_cache, deadline)
+    for key in present:
+        report_result[key] = "true"
+    for key in unchecked:
+        report_result[key] = "unchecked"
     return report_result
 
 
-def find_ingested_epv(ecosystem, pvlist):
+def find_ingested_epv(ecosystem, pvlist, epv_cache=None):
     """Generate a report for the unknown EPVs.
 
     :param epv_list: list, list of EPVs
+    :param epv_cache: PersistentCache, cache of EPV existence in the graph
     :return json, list of epv information
     """
-    query_str = "g.V().has('pecosystem', '{arg0}')." \
-                "has('pname', '{arg1}').has('version', '{arg2}')" \
-                ".valueMap().dedup().fill(epv);"
     report_result = {}
-    args = []
+    epv_keys = []
     for pv in pvlist:
         pkg, ver = pv['name'], pv['version']
-        args.append({
-            "0": ecosystem,
-            "1": pkg,
-            "2": ver
-        })
+        epv_keys.append((ecosystem, pkg, ver))
         report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Unknown'
 
-    result_data = batch_query_executor(query_str, args)
-    if result_data is not None:
-        for res in result_data:
-            pkg = get_value(res, 'pname')
-            ver = get_value(res, 'version')
-            report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Ingested'
+    ingested = 0
+    present, _ = find_epvs_in_graph(epv_keys, epv_cache)
+    for _, pkg, ver in present:
+        report_result['{pkg} {ver}'.format(pkg=pkg, ver=ver)] = 'Ingested'
+        ingested += 1
 
     return {'total_previously_unknown_dependencies': len(pvlist),
-            'ingested_dependencies': len(result_data) if result_data else 0,
+            'ingested_dependencies': ingested,
             'report': report_result}
 
 
-def generate_report_for_latest_version(epv_list, day):
+def fetch_latest_versions(packages, version_cache=None):
+    """Look up the latest versions of the packages in the upstream registries.
+
+    Lookups missing from the cache run concurrently, limited per ecosystem so that
+    no single registry gets more than UPSTREAM_LOOKUP_ECOSYSTEM_WORKERS calls at once.
+
+    :param packages: list, list of (ecosystem, name) tuples
+    :param version_cache: PersistentCache, cache of upstream latest versions
+    :return dict, latest version for each (ecosystem, name) tuple
+    """
+    latest_versions = {}
+    pending = {}
+    for key in dict.fromkeys(packages):
+        cached = version_cache.get(key) if version_cache is not None else None
+        if cached is None:
+            pending.setdefault(key[0], []).append(key)
+        else:
+            latest_versions[key] = cached
+    if version_cache is not None:
+        version_cache.log_stats()
+
+    limits = {eco: threading.BoundedSemaphore(UPSTREAM_LOOKUP_ECOSYSTEM_WORKERS)
+              for eco in pending}
+
+    def lookup(eco, pkg):
+        with limits[eco]:
+            return get_latest_versions_for_ep(eco, pkg)
+
+    # Interleave the ecosystems so a large one does not hold up the pool
+    keys = [key for keys in itertools.zip_longest(*pending.values()) for key in keys if key]
+    with ThreadPoolExecutor(max_workers=UPSTREAM_LOOKUP_WORKERS) as executor:
+        futures = {key: executor.submit(lookup, *key) for key in keys}
+
+    for key, future in futures.items():
+        try:
+            latest_versions[key] = future.result()
+        except Exception:
+            _logger.error("Unable to get the upstream latest version for {e} {p}\n{tb}".format(
+                e=key[0], p=key[1], tb=traceback.format_exc()))
+            latest_versions[key] = ""
+            continue
+        # An empty answer is kept as a negative entry, which expires after the negative TTL
+        if version_cache is not None:
+            version_cache.set(key, latest_versions[key] or "")
+    return latest_versions
+
+
+def generate_report_for_latest_version(epv_list, day, version_cache=None, deadline=None):
     """Generate a report for the latest version.
 
+    Packages that could not be looked up in the graph are flagged as unchecked.
+
     :param epv_list: list, list of EPVs
-    :return json, list of version information
+    :param day: date, day the graph latest versions are expected to be updated on
+    :param version_cache: PersistentCache, cache of upstream latest versions
+    :param deadline: Deadline, time budget for the graph queries
+    :return dict, version information keyed by (ecosystem, name) tuples
     """
     _logger.info("generating report for latest version.")
     query_str = "g.V().has('ecosystem', '{arg0}')." \
@@ -171,6 +388,9 @@ def generate_report_for_latest_version(epv_list, day):
     for epv in epv_list:
         eco = epv['ecosystem']
         pkg = epv['name']
+        # One lookup per package is enough for all of its versions
+        if (eco, pkg) in report_result:
+            continue
         args.append({
             "0": eco,
             "1": pkg
@@ -182,27 +402,38 @@ def generate_report_for_latest_version(epv_list, day):
             "actual_latest_version": "",
             "non_cve_version": ""
         }
-        report_result[eco + "@DELIM@" + pkg] = tmp
+        report_result[(eco, pkg)] = tmp
 
-    result_data = batch_query_executor(query_str, args)
+    unchecked_args = []
+    result_data = batch_query_executor(query_str, args, 'package', deadline, unchecked_args)
+    for arg in unchecked_args:
+        report_result[(arg['0'], arg['1'])]['unchecked'] = True
     today = day.strftime('%Y%m%d')
     yesterday = (day - timedelta(days=1)).strftime('%Y%m%d')
+    upstream = []
     if result_data is not None:
+        processed = set()
         for res in result_data:
             eco = get_value(res, 'ecosystem')
             pkg = get_value(res, 'name')
+            if (eco, pkg) in processed or (eco, pkg) not in report_result:
+                continue
+            processed.add((eco, pkg))
+            pkg_result = report_result[(eco, pkg)]
             latest_pkg_version = get_value(res, 'latest_version')
             non_cve_version = get_value(res, 'latest_non_cve_version')
             last_updated_date = get_value(res, 'latest_version_last_updated')
             if last_updated_date == today or last_updated_date == yesterday:
-                report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest_pkg_version
+                pkg_result['actual_latest_version'] = latest_pkg_version
             else:
                 _logger.info("Dates don't match. Will pick the version from upstream for {e} {p}"
                              .format(e=eco, p=pkg))
-                latest = get_latest_versions_for_ep(eco, pkg)
-                report_result[eco + "@DELIM@" + pkg]['actual_latest_version'] = latest
-            report_result[eco + "@DELIM@" + pkg]['known_latest_version'] = latest_pkg_version
-            report_result[eco + "@DELIM@" + pkg]['non_cve_version'] = non_cve_version
+                upstream.append((eco, pkg))
+            pkg_result['known_latest_version'] = latest_pkg_version
+            pkg_result['non_cve_version'] = non_cve_version
+
+    for key, latest in fetch_latest_versions(upstream, version_cache).items():
+        report_result[key]['actual_latest_version'] = latest
 
     return report_result
 
@@ -210,7 +441,7 @@ def generate_report_for_latest_version(epv_list, day):
 def execute_gremlin_dsl(payload, url=GREMLIN_SERVER_URL_REST):
     """Execute the gremlin query and return the response."""
     try:
-        response = get_session_retry().post(url, json=payload)
+        response = get_graph_session().post(url, json=payload, timeout=GREMLIN_TIMEOUT)
         if response.status_code == 200:
             return response.json()
         else:
@@ -235,6 +466,21 @@ def get_session_retry(retries=5, backoff_factor=1.0, status_forcelist=(404, 500,
     return session
 
 
+_graph_session = None
+
+
+def get_graph_session():
+    """Get the pooled session used for all the gremlin queries.
+
+    A gremlin 404 is not transient, so unlike get_session_retry it is not retried.
+    """
+    global _graph_session
+    if _graph_session is None:
+        _graph_session = get_session_retry(retries=GREMLIN_RETRIES,
+                                           status_forcelist=(500, 502, 504))
+    return _graph_session
+
+
 def get_response_data(json_response, data_default):
     """Retrieve data from the JSON response.
 
@@ -250,40 +496,92 @@ def get_value(json, attr):
     return ""
 
 
-def batch_query_executor(query_string, args):
-    """Execute the gremlin query in batches of 50."""
-    query = "epv=[];"
-    tmp_query = ""
-    counter = 0
-    result_data = []
-    for arg in args:
-        if len(arg) == 2:
-            tmp_query = query_string.format(arg0=arg['0'], arg1=arg['1'])
-            counter += 1
-        elif len(arg) == 3:
-            tmp_query = query_string.format(arg0=arg['0'], arg1=arg['1'], arg2=arg['2'])
-            counter += 1
-        if counter == 1:
-            query = "epv=[];"
-        query += tmp_query
-
-        if counter >= GREMLIN_QUERY_SIZE:
-            counter = 0
-            payload = {'gremlin': query}
-            gremlin_response = execute_gremlin_dsl(payload)
-            if gremlin_response is not None:
-                result_data += get_response_data(gremlin_response, [{0: 0}])
-            else:
-                _logger.error("Error while trying to fetch data from graph. "
-                              "Expected response, got None...Query->", query)
+class BatchSizer:
+    """Adapt the gremlin batch size of one query type to the observed latency.
+
+    The size grows by a fixed step after every full batch answered within the target
+    latency and is halved after a failed or slow batch, staying within the bounds.
+    """
+
+    def __init__(self, size=GREMLIN_QUERY_SIZE, min_size=GREMLIN_QUERY_SIZE_MIN,
+                 max_size=GREMLIN_QUERY_SIZE_MAX, step=GREMLIN_QUERY_SIZE_STEP,
+                 target_seconds=GREMLIN_QUERY_TARGET_SECONDS):
+        """Init method for the BatchSizer class."""
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(size, max_size))
+        self.step = step
+        self.target_seconds = target_seconds
+        self.batches = 0
+        self.errors = 0
+
+    def record(self, batch_len, elapsed, success):
+        """Adjust the batch size based on the outcome of one batch."""
+        self.batches += 1
+        if not success:
+            self.errors += 1
+        if not success or elapsed > self.target_seconds:
+            self.size = max(self.min_size, self.size // 2)
+        elif batch_len >= self.size:
+            self.size = min(self.max_size, self.size + self.step)
 
-    if counter < GREMLIN_QUERY_SIZE:
+
+_batch_sizers = {}
+
+
+def get_batch_sizes(since=None):
+    """Get the current batch size and batch statistics of every query type.
+
+    The batch sizes carry over between reports, the statistics keep growing for the
+    whole process.
+
+    :param since: dict, an earlier result of get_batch_sizes; only the batches sent after
+        it are counted and the query types without any are left out
+    """
+    since = since or {}
+    batch_sizes = {}
+    for query_type, sizer in list(_batch_sizers.items()):
+        before = since.get(query_type, {})
+        batches = sizer.batches - before.get('batches', 0)
+        if since and not batches:
+            continue
+        batch_sizes[query_type] = {'batch_size': sizer.size,
+                                   'batches': batches,
+                                   'errors': sizer.errors - before.get('errors', 0)}
+    return batch_sizes
+
+
+def batch_query_executor(query_string, args, query_type='default', deadline=None,
+                         unchecked=None):
+    """Execute the gremlin query in batches sized adaptively per query type.
+
+    Once the deadline expires no more batches are sent. The args of the batches that
+    were skipped or failed are appended to the unchecked list when one is given.
+    """
+    sizer = _batch_sizers.setdefault(query_type, BatchSizer())
+    result_data = []
+    start = 0
+    while start < len(args):
+        if deadline is not None and deadline.expired():
+            _logger.error("Graph time budget exhausted, {n} {t} lookups left unchecked".format(
+                n=len(args) - start, t=query_type))
+            if unchecked is not None:
+                unchecked.extend(args[start:])
+            break
+        batch = args[start:start + sizer.size]
+        start += len(batch)
+        query = "epv=[];" + "".join(
+            query_string.format(**{'arg' + k: v for k, v in arg.items()}) for arg in batch)
         payload = {'gremlin': query}
+        started = time.monotonic()
         gremlin_response = execute_gremlin_dsl(payload)
+        sizer.record(len(batch), time.monotonic() - started, gremlin_response is not None)
         if gremlin_response is not None:
             result_data += get_response_data(gremlin_response, [{0: 0}])
         else:
             _logger.error("Error while trying to fetch data from graph. "
-                          "Expected response, got None...Query->", query)
+                          "Expected response, got None...Query->{}".format(query))
+            if unchecked is not None:
+                unchecked.extend(batch)
 
     return result_data
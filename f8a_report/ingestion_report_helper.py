@@ -0,0 +1,376 @@
+"""Ingestion report of the EPVs analysed in a period, completed by later runs."""
+
+import json
+import logging
+import os
+from datetime import datetime as dt
+from graph_report_generator import generate_report_for_unknown_epvs, \
+    generate_report_for_latest_version, latest_version_sync, get_batch_sizes, Deadline
+
+logger = logging.getLogger(__file__)
+
+
+class IngestionReportHelper:
+    """Check the ingested EPVs against the graph and upstream, and save the report."""
+
+    def __init__(self, s3, epv_cache, latest_version_cache):
+        """Init method for the IngestionReportHelper class.
+
+        :param s3: S3Helper, storage of the reports
+        :param epv_cache: PersistentCache, EPVs known to be in the graph or not
+        :param latest_version_cache: PersistentCache, upstream latest versions of the packages
+        """
+        self.s3 = s3
+        self.epv_cache = epv_cache
+        self.latest_version_cache = latest_version_cache
+        # Seconds the graph lookups of the ingestion report may take, 0 for no limit
+        self.graph_enrichment_budget = int(os.getenv('GRAPH_ENRICHMENT_BUDGET', 1800)) or None
+
+    def normalize_ingestion_data(self, start_date, end_date, ingestion_data, frequency='daily'):
+        """Normalize worker data for reporting."""
+        logger.info("Normalize Ingestion Data started")
+        report_type = 'ingestion-data'
+        if frequency == 'monthly':
+            report_name = dt.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m')
+        else:
+            report_name = dt.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+        template = {
+            'report': {
+                'from': start_date,
+                'to': end_date,
+                'generated_on': dt.now().isoformat('T')
+            },
+            'ingestion_summary': {},
+            'ingestion_details': {}
+        }
+
+        epv_data = ingestion_data['EPV_DATA']
+        epv_data = json.loads(epv_data)
+
+        # Populate the default template with EPV info
+        template, epvs = self.populate_default_information(epv_data, template)
+        template = self.enrich_ingestion_data(epvs, template)
+
+        # Saving the final report in the relevant S3 bucket
+        self.save_ingestion_report(report_type, report_name, template)
+        return template
+
+    def populate_default_information(self, epv_data, template):
+        """To populate the default information in the template."""
+        epvs = []
+        ing_details = {}
+        for epv in epv_data:
+            eco = epv[0]
+            pkg = epv[1]
+            ver = epv[2]
+            epv_template = {
+                'ecosystem': eco,
+                'name': pkg,
+                'version': ver
+            }
+            epvs.append(epv_template)
+
+            # Add eco key in json if missing
+            if eco not in ing_details:
+                ing_details[eco] = {}
+
+            # Add pkg key in json if missing
+            if pkg not in ing_details[eco]:
+                ing_details[eco][pkg] = {}
+
+            # Add version key in json if missing
+            if ver not in ing_details[eco][pkg]:
+                ing_details[eco][pkg][ver] = {}
+
+        # Add the EPV information to the template
+        template['ingestion_details'] = ing_details
+        return template, epvs
+
+    def generate_results(self, epvs, template, pkg_output, ver_output):
+        """Get package information from graph."""
+        template['ingestion_summary']['incorrect_latest_version'] = {}
+        template['ingestion_summary']['unknown_deps'] = {}
+        template['ingestion_summary']['unchecked'] = {}
+        count = {}
+        latest_epvs = []
+        checked_pkgs = set()
+        latest_pkgs = set()
+        unchecked_epvs = set()
+        for epv in epvs:
+            eco = epv['ecosystem']
+            pkg = epv['name']
+            ver = epv['version']
+
+            # Add parameters to count the different params
+            if eco not in count:
+                count[eco] = {
+                    'incorrect_latest_versions': 0,
+                    'correct_latest_versions': 0,
+                    'ingested_in_graph': 0,
+                    'not_ingested_in_graph': 0,
+                    'unchecked': 0
+                }
+            if eco not in template['ingestion_summary']['incorrect_latest_version']:
+                template['ingestion_summary']['incorrect_latest_version'][eco] = []
+                template['ingestion_summary']['unknown_deps'][eco] = []
+                template['ingestion_summary']['unchecked'][eco] = []
+            pkg_data = pkg_output[(eco, pkg)]
+            ver_data = ver_output[(eco, pkg, ver)]
+            actual_latest_ver = pkg_data['actual_latest_version']
+
+            # The graph time budget ran out before this EPV was checked
+            if pkg_data.get('unchecked') or ver_data == "unchecked":
+                template['ingestion_details'][eco][pkg][ver]['synced_to_graph'] = "unchecked"
+                if (eco, pkg, ver) not in unchecked_epvs:
+                    unchecked_epvs.add((eco, pkg, ver))
+                    template['ingestion_summary']['unchecked'][eco].append(epv)
+                    count[eco]['unchecked'] += 1
+                continue
+
+            # check if the package is publicly available
+            if actual_latest_ver:
+                known_latest_ver = pkg_data['known_latest_version']
+                if actual_latest_ver != known_latest_ver and (eco, pkg) not in checked_pkgs:
+                    checked_pkgs.add((eco, pkg))
+                    tmp = {
+                        "package": pkg,
+                        "actual_latest_version": actual_latest_ver,
+                        "known_latest_version": known_latest_ver
+                    }
+                    template['ingestion_summary']['incorrect_latest_version'][eco].append(tmp)
+                    count[eco]['incorrect_latest_versions'] += 1
+
+                template['ingestion_details'][eco][pkg]['known_latest_version'] \
+                    = known_latest_ver
+                template['ingestion_details'][eco][pkg]['actual_latest_version'] \
+                    = actual_latest_ver
+                non_cve_version = pkg_data.get('non_cve_version', '')
+                if non_cve_version:
+                    template['ingestion_details'][eco][pkg]['non_cve_version'] \
+                        = non_cve_version
+                if (eco, pkg) not in latest_pkgs:
+                    latest_pkgs.add((eco, pkg))
+                    latest_json = {
+                        "ecosystem": eco,
+                        "name": pkg,
+                        "version": actual_latest_ver
+                    }
+                    latest_epvs.append(latest_json)
+
+                # Count the correct latest version EPVs
+                if actual_latest_ver == known_latest_ver:
+                    count[eco]['correct_latest_versions'] += 1
+
+                # Add to report if the EPV exist in the graph or not
+                template['ingestion_details'][eco][pkg][ver]['synced_to_graph'] = ver_data
+                if ver_data == "false":
+                    template['ingestion_summary']['unknown_deps'][eco].append(epv)
+                    count[eco]['not_ingested_in_graph'] += 1
+                else:
+                    count[eco]['ingested_in_graph'] += 1
+            else:
+                # Mark the package as private as the information is not present publicly
+                template['ingestion_details'][eco][pkg]['private_pkg'] = "true"
+
+        # For each ecosystem, calculate the %age accuracy
+        for eco in count:
+            self.set_ingestion_accuracy(count[eco])
+
+            # Rectify the latest versions only if present
+            if count[eco]['incorrect_latest_versions'] != 0:
+                summary = template['ingestion_summary']
+                logger.info("Information related to incorrect latest version --")
+                logger.info(summary['incorrect_latest_version'][eco])
+                latest_version_sync.submit(summary['incorrect_latest_version'][eco], eco)
+        template['ingestion_summary']['stats'] = count
+        return template, latest_epvs
+
+    @staticmethod
+    def set_ingestion_accuracy(stats):
+        """Calculate the %age accuracy of the ingestion stats of an ecosystem."""
+        correct = stats['correct_latest_versions']
+        incorrect = stats['incorrect_latest_versions']
+        # Calculate the %age of latest version accuracy
+        if correct != 0 or incorrect != 0:
+            stats['latest_version_accuracy'] = round(((correct * 100) /
+                                                      (correct + incorrect)), 2)
+
+        correct = stats['ingested_in_graph']
+        incorrect = stats['not_ingested_in_graph']
+        # Calculate the %age of successful ingestion
+        if correct != 0 or incorrect != 0:
+            stats['ingestion_accuracy'] = round(((correct * 100) /
+                                                 (correct + incorrect)), 2)
+        return stats
+
+    def check_latest_node(self, latest_epvs, template, deadline=None, graph_output=None):
+        """Get if latest node is present in graph.
+
+        The graph is queried only when the output of an earlier EPV lookup that
+        covered the latest EPVs is not given.
+        """
+        if graph_output is None:
+            graph_output = generate_report_for_unknown_epvs(latest_epvs, self.epv_cache,
+                                                            deadline)
+        missing_latest = {}
+        for epv in latest_epvs:
+            eco = epv['ecosystem']
+            pkg = epv['name']
+            ver = epv['version']
+            output = graph_output[(eco, pkg, ver)]
+            template['ingestion_details'].setdefault(eco, {}).setdefault(pkg, {})[
+                'latest_node_in_graph'] = output
+
+            # The graph time budget ran out before the latest node was checked
+            if output == "unchecked":
+                template['ingestion_summary'].setdefault('unchecked', {}).setdefault(
+                    eco, []).append({**epv, 'latest_node': True})
+
+            # If the EPV is missing in graph, add it to the summary
+            if output == "false":
+                if eco not in missing_latest:
+                    missing_latest[eco] = []
+                tmp = {
+                    "package": pkg,
+                    "version": ver
+                }
+                missing_latest[eco].append(tmp)
+        template['ingestion_summary']['missing_latest_node'] = missing_latest
+        return template
+
+    def enrich_ingestion_data(self, epvs, template, latest_nodes=()):
+        """Add the graph and upstream information of the EPVs to the template.
+
+        The graph lookups share a time budget, the EPVs left once it runs out are
+        reported as unchecked.
+
+        :param latest_nodes: list, latest version EPVs to check in the graph besides the
+            ones of the EPVs
+        """
+        deadline = Deadline(self.graph_enrichment_budget)
+        batch_sizes = get_batch_sizes()
+        logger.info("Fetching details of the latest version for the epvs")
+        today = dt.today()
+        pkg_output = generate_report_for_latest_version(epvs, today, self.latest_version_cache,
+                                                        deadline)
+        self.latest_version_cache.save()
+
+        # Look up the latest version EPVs together with the ingested ones, so that
+        # every distinct EPV is queried at most once
+        latest_epvs = [{
+            'ecosystem': pkg_data['ecosystem'],
+            'name': pkg_data['name'],
+            'version': pkg_data['actual_latest_version']
+        } for pkg_data in pkg_output.values() if pkg_data['actual_latest_version']]
+        latest_epvs += latest_nodes
+        logger.info("Fetching details of the unknown packages and latest versions for the epvs")
+        ver_output = generate_report_for_unknown_epvs(epvs + latest_epvs, self.epv_cache,
+                                                      deadline)
+
+        # Call the function to add the package information to the template
+        template, latest_epvs = self.generate_results(epvs, template, pkg_output, ver_output)
+
+        # Call the function to get the availability of latest node
+        logger.info("Checking if latest node exists in graph")
+        template = self.check_latest_node(latest_epvs + list(latest_nodes), template,
+                                          deadline, ver_output)
+        self.epv_cache.save()
+
+        # Export the gremlin batch sizes chosen for this report
+        template['ingestion_summary']['graph_batch_sizes'] = get_batch_sizes(batch_sizes)
+        logger.info("Gremlin batch sizes: {}".format(
+            template['ingestion_summary']['graph_batch_sizes']))
+        return template
+
+    def save_ingestion_report(self, report_type, report_name, template):
+        """Save the ingestion report in S3 bucket."""
+        try:
+            obj_key = '{type}/epv/{report_name}.json'.format(
+                type=report_type, report_name=report_name
+            )
+            self.s3.store_json_content(content=template, obj_key=obj_key,
+                                       bucket_name=self.s3.report_bucket_name)
+        except Exception as e:
+            logger.exception('Unable to store the report on S3. Reason: %r' % e)
+
+    @staticmethod
+    def merge_ingestion_data(template, partial):
+        """Merge the results of a follow-up run into a partial ingestion report."""
+        for eco, pkgs in partial['ingestion_details'].items():
+            for pkg, details in pkgs.items():
+                template['ingestion_details'].setdefault(eco, {}).setdefault(pkg, {}).update(
+                    details)
+
+        summary = template['ingestion_summary']
+        partial_summary = partial['ingestion_summary']
+        for eco, stats in partial_summary['stats'].items():
+            eco_stats = summary.setdefault('stats', {}).setdefault(eco, {
+                'incorrect_latest_versions': 0,
+                'correct_latest_versions': 0,
+                'ingested_in_graph': 0,
+                'not_ingested_in_graph': 0
+            })
+            # A package may already be reported with its incorrect latest version
+            incorrect = summary['incorrect_latest_version'].setdefault(eco, [])
+            reported = {item['package'] for item in incorrect}
+            for item in partial_summary['incorrect_latest_version'].get(eco, []):
+                if item['package'] not in reported:
+                    incorrect.append(item)
+                    eco_stats['incorrect_latest_versions'] += 1
+            summary['unknown_deps'].setdefault(eco, []).extend(
+                partial_summary['unknown_deps'].get(eco, []))
+            for key in ('correct_latest_versions', 'ingested_in_graph',
+                        'not_ingested_in_graph'):
+                eco_stats[key] += stats[key]
+            IngestionReportHelper.set_ingestion_accuracy(eco_stats)
+
+        # A package may already be reported with its missing latest node
+        for eco, missing in partial_summary['missing_latest_node'].items():
+            missing_latest = summary.setdefault('missing_latest_node', {}).setdefault(eco, [])
+            reported = {item['package'] for item in missing_latest}
+            missing_latest.extend(item for item in missing if item['package'] not in reported)
+
+        summary['unchecked'] = partial_summary['unchecked']
+        # The stats count the EPVs still unchecked, latest nodes are not part of them
+        for eco, eco_stats in summary.get('stats', {}).items():
+            eco_stats['unchecked'] = sum(1 for epv in summary['unchecked'].get(eco, [])
+                                         if not epv.get('latest_node'))
+        summary['graph_batch_sizes'] = partial_summary['graph_batch_sizes']
+        return template
+
+    def fill_unchecked_ingestion_data(self, end_date, frequency='daily'):
+        """Check the EPVs a previous run left unchecked and update its ingestion report."""
+        report_type = 'ingestion-data'
+        report_name = dt.strptime(end_date, '%Y-%m-%d').strftime(
+            '%Y-%m' if frequency == 'monthly' else '%Y-%m-%d')
+        obj_key = '{type}/epv/{report_name}.json'.format(
+            type=report_type, report_name=report_name)
+        template = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
+                                            obj_key=obj_key)
+        if not template:
+            return None
+
+        unchecked = [epv for epvs in template['ingestion_summary'].get('unchecked', {}).values()
+                     for epv in epvs]
+        if not unchecked:
+            return template
+        logger.info("Checking {n} EPVs left unchecked in the ingestion report {r}".format(
+            n=len(unchecked), r=report_name))
+
+        # Latest nodes are only looked up in the graph, they are not part of the stats,
+        # and the packages of the unchecked EPVs get their latest node checked anyway
+        epv_data = [(epv['ecosystem'], epv['name'], epv['version'])
+                    for epv in unchecked if not epv.get('latest_node')]
+        pkgs = {(eco, pkg) for eco, pkg, _ in epv_data}
+        latest_nodes = [{'ecosystem': epv['ecosystem'], 'name': epv['name'],
+                         'version': epv['version']}
+                        for epv in unchecked
+                        if epv.get('latest_node') and (epv['ecosystem'], epv['name']) not in pkgs]
+        partial = {'ingestion_summary': {}, 'ingestion_details': {}}
+        partial, epvs = self.populate_default_information(epv_data, partial)
+        partial = self.enrich_ingestion_data(epvs, partial, latest_nodes)
+        template = self.merge_ingestion_data(template, partial)
+
+        self.save_ingestion_report(report_type, report_name, template)
+        return template
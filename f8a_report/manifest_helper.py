@@ -11,6 +11,9 @@ from json import JSONDecodeError
 logger = logging.getLogger(__file__)
 logging.basicConfig(level=logging.INFO)
 
+# Number of manifests of each ecosystem picked from the stack analyses requests
+STACK_SAMPLE_SIZE = 3
+
 
 class GetReport:
     """This creates a manifest file for all ecosystem and save to s3."""
@@ -109,7 +112,7 @@ class FilterStacks:
                     for stack_report in sampled_stack_reports]
 
 
-def manifest_interface(stack_report, stack_size=3):
+def manifest_interface(stack_report, stack_size=STACK_SAMPLE_SIZE):
     """Initialize function, executed first."""
     return FilterStacks().filter_stacks_on_ecosystem(
         stack_report=stack_report, stack_size=stack_size)
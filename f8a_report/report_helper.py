@@ -7,22 +7,29 @@ import logging
 import psycopg2
 import psycopg2.extras
 import itertools
+import random
 import requests
 import heapq
+from functools import partial
 from operator import itemgetter
 from datetime import datetime as dt
 from psycopg2 import sql
 from collections import Counter
-from graph_report_generator import generate_report_for_unknown_epvs, \
-    generate_report_for_latest_version, rectify_latest_version
+from graph_report_generator import latest_version_sync
 from s3_helper import S3Helper
+from cache_helper import get_persistent_cache
 from unknown_deps_report_helper import UnknownDepsReportHelper
+from ingestion_report_helper import IngestionReportHelper
 from sentry_report_helper import SentryReportHelper
-from cve_helper import CVE
+from cve_helper import cve_report_provider
 
 logger = logging.getLogger(__file__)
 logging.basicConfig(level=logging.INFO)
 
+# Sample the manifests in Postgres, or stream them through a reservoir per ecosystem
+MANIFEST_SQL_SAMPLING = os.getenv('MANIFEST_SQL_SAMPLING', 'True') in ('True', 'true', '1')
+MANIFEST_ECOSYSTEMS = ('npm', 'maven', 'pypi')
+
 
 class Postgres:
     """Postgres connection session handler."""
@@ -47,7 +54,31 @@ class ReportHelper:
         self.pg = Postgres()
         self.conn = self.pg.conn
         self.cursor = self.pg.cursor
-        self.unknown_deps_helper = UnknownDepsReportHelper()
+        # EPVs stay in the graph once ingested, so only negative entries need a short TTL
+        self.epv_cache = get_persistent_cache(
+            'graph-epvs', s3=self.s3,
+            ttl=int(os.getenv('EPV_CACHE_TTL', 30 * 24 * 3600)),
+            negative_ttl=int(os.getenv('EPV_CACHE_NEGATIVE_TTL', 3600)),
+            refresh_on_hit=True)
+        # Packages without a version upstream are looked up again sooner
+        self.latest_version_cache = get_persistent_cache(
+            'upstream-latest-versions', s3=self.s3,
+            ttl=int(os.getenv('LATEST_VERSION_CACHE_TTL', 24 * 3600)),
+            negative_ttl=int(os.getenv('LATEST_VERSION_CACHE_NEGATIVE_TTL', 3600)))
+        # Record of the stack packages submitted for a latest version sync
+        self.sync_cache = get_persistent_cache(
+            'latest-version-syncs', s3=self.s3,
+            ttl=int(os.getenv('SYNC_LATEST_VERSION_WINDOW_DAYS', 7)) * 24 * 3600)
+        # CVE reports of the past days, so that a retried run does not search GitHub again
+        self.cve_report_cache = get_persistent_cache(
+            'cve-reports', s3=self.s3,
+            ttl=int(os.getenv('CVE_REPORT_CACHE_TTL', 2 * 24 * 3600)))
+        self.github_etag_cache = get_persistent_cache(
+            'github-etags', s3=self.s3,
+            ttl=int(os.getenv('GITHUB_ETAG_CACHE_TTL', 7 * 24 * 3600)))
+        self.unknown_deps_helper = UnknownDepsReportHelper(epv_cache=self.epv_cache)
+        self.ingestion_helper = IngestionReportHelper(self.s3, self.epv_cache,
+                                                      self.latest_version_cache)
         self.sentry_helper = SentryReportHelper()
         self.npm_model_bucket = os.getenv('NPM_MODEL_BUCKET')
         self.maven_model_bucket = os.getenv('MAVEN_MODEL_BUCKET')
@@ -135,26 +166,52 @@ class ReportHelper:
         """Get Timedelta object."""
         return dt.strptime(end_date, '%Y-%m-%d') - dt.strptime(start_date, '%Y-%m-%d')
 
-    def retrieve_stack_analyses_content(self, start_date, end_date):
-        """Retrieve results for stack analyses requests."""
+    def retrieve_stack_analyses_sample(self, start_date, end_date, sample_size):
+        """Retrieve a random sample of the stack analyses requests of each ecosystem.
+
+        :return list, rows holding the requestJson of at most sample_size requests
+            for each ecosystem
+        """
         try:
-            # start_date from which data is to be fetched
             start_date = self.validate_and_process_date(start_date)
-            # end_date up to which data is to be fetched
             end_date = self.validate_and_process_date(end_date)
         except ValueError:
-            # checks Invalid date format
             raise ValueError("Invalid date format")
 
-        # Query to fetch Stack Analysis manifests data from start_date to end_date
-        query = sql.SQL('SELECT {} FROM {} WHERE {} BETWEEN \'%s\' AND \'%s\'').format(
-            sql.Identifier('requestJson'), sql.Identifier('stack_analyses_request'),
-            sql.Identifier('submitTime')
-        )
-        # Executing Query
-        self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
-        # Fetching all results
-        return self.cursor.fetchall()
+        ecosystem = sql.SQL('{}->\'manifest\'->0->>\'ecosystem\'').format(
+            sql.Identifier('requestJson'))
+        params = (start_date, end_date, MANIFEST_ECOSYSTEMS)
+        if MANIFEST_SQL_SAMPLING:
+            # Number the requests of each ecosystem in a random order and keep the first ones
+            query = sql.SQL('SELECT {request} FROM (SELECT {request}, ROW_NUMBER() OVER '
+                            '(PARTITION BY {ecosystem} ORDER BY RANDOM()) AS rank FROM {table} '
+                            'WHERE {time} BETWEEN %s AND %s AND {ecosystem} IN %s) AS requests '
+                            'WHERE rank <= %s').format(
+                request=sql.Identifier('requestJson'), ecosystem=ecosystem,
+                table=sql.Identifier('stack_analyses_request'),
+                time=sql.Identifier('submitTime'))
+            self.cursor.execute(query, params + (sample_size,))
+            return self.cursor.fetchall()
+
+        query = sql.SQL('SELECT {ecosystem}, {request} FROM {table} '
+                        'WHERE {time} BETWEEN %s AND %s AND {ecosystem} IN %s').format(
+            request=sql.Identifier('requestJson'), ecosystem=ecosystem,
+            table=sql.Identifier('stack_analyses_request'), time=sql.Identifier('submitTime'))
+        reservoirs = {}
+        seen = Counter()
+        # A server side cursor streams the requests instead of fetching them all
+        with self.conn.cursor(name='stack_analyses_sample') as cursor:
+            cursor.execute(query, params)
+            for eco, request in cursor:
+                seen[eco] += 1
+                reservoir = reservoirs.setdefault(eco, [])
+                if len(reservoir) < sample_size:
+                    reservoir.append((request,))
+                else:
+                    index = random.randrange(seen[eco])
+                    if index < sample_size:
+                        reservoir[index] = (request,)
+        return list(itertools.chain.from_iterable(reservoirs.values()))
 
     def flatten_list(self, alist):
         """Convert a list of lists to a single list."""
@@ -206,10 +263,13 @@ class ReportHelper:
         """Collate previous raw data with this week/month data."""
         result = {}
 
-        # Get collated user input data
+        # Get collated user input and big query data
+        bucket_name = self.s3.report_bucket_name
         collated_user_input_obj_key = 'user-input-data/collated-{freq}.json'.format(freq=frequency)
-        collated_user_input = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
-                                                       obj_key=collated_user_input_obj_key) or {}
+        collated_big_query_obj_key = 'big-query-data/collated.json'
+        collated = self.s3.get_many([(bucket_name, collated_user_input_obj_key),
+                                     (bucket_name, collated_big_query_obj_key)], cache=True)
+        collated_user_input = collated[(bucket_name, collated_user_input_obj_key)] or {}
 
         for eco in unique_stacks_with_recurrence_count.keys() | collated_user_input.keys():
             result.update({eco: {
@@ -222,10 +282,7 @@ class ReportHelper:
         self.s3.store_json_content(content=result, bucket_name=self.s3.report_bucket_name,
                                    obj_key=collated_user_input_obj_key)
 
-        # Get collated big query data
-        collated_big_query_obj_key = 'big-query-data/collated.json'
-        collated_big_query_data = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
-                                                           obj_key=collated_big_query_obj_key) or {}
+        collated_big_query_data = collated[(bucket_name, collated_big_query_obj_key)] or {}
 
         for eco in collated_big_query_data.keys():
             if result.get(eco):
@@ -288,11 +345,11 @@ class ReportHelper:
     def store_training_data(self, result):
         """Store Training Data for each ecosystem in their respective buckets."""
         model_version = dt.now().strftime('%Y-%m-%d')
+        obj_key = '{model_version}/data/manifest.json'.format(model_version=model_version)
+        uploads = []
+        retrain = []
 
         for eco, stack_dict in result.items():
-            training_data = self.get_training_data_for_ecosystem(eco, stack_dict)
-            obj_key = '{model_version}/data/manifest.json'.format(model_version=model_version)
-
             # Get the bucket name based on ecosystems to store user-input stacks for retraining
             if eco == 'maven':
                 bucket_name = self.maven_model_bucket
@@ -316,16 +373,24 @@ class ReportHelper:
             if bucket_name:
                 logger.info('Storing user-input stacks for ecosystem {eco} at {dir}'.format(
                     eco=eco, dir=bucket_name + obj_key))
-                try:
-                    # Store the training content for each ecosystem
-                    self.s3.store_json_content(content=training_data, bucket_name=bucket_name,
-                                               obj_key=obj_key)
-                    # Invoke the EMR API to kickstart retraining process
-                    # This EMR invocation happens for all ecosystems almost at the same time.
-                    # TODO - find an alternative if there is a need
-                    self.invoke_emr_api(bucket_name, eco, model_version, github_repo)
-                except Exception as e:
-                    logger.error('Unable to invoke EMR API. Reason: %r' % e)
+                training_data = self.get_training_data_for_ecosystem(eco, stack_dict)
+                uploads.append((bucket_name, obj_key, training_data))
+                retrain.append((bucket_name, eco, github_repo))
+
+        # Store the training content for all the ecosystems at once
+        stored = self.s3.put_many(uploads)
+        for bucket_name, eco, github_repo in retrain:
+            if not stored[(bucket_name, obj_key)]:
+                logger.error('Unable to store the training data for {eco}, skipping the '
+                             'retraining'.format(eco=eco))
+                continue
+            try:
+                # Invoke the EMR API to kickstart retraining process
+                # This EMR invocation happens for all ecosystems almost at the same time.
+                # TODO - find an alternative if there is a need
+                self.invoke_emr_api(bucket_name, eco, model_version, github_repo)
+            except Exception as e:
+                logger.error('Unable to invoke EMR API. Reason: %r' % e)
 
     def get_trending(self, mydict, top_trending_count=3):
         """Generate the top trending items list."""
@@ -336,7 +401,7 @@ class ReportHelper:
                               avg_response_time, unknown_deps_ingestion_report):
         """Generate ecosystem specific stack summary."""
         unique_dep_frequency = self.populate_key_count(self.flatten_list(all_deps[ecosystem]))
-        rectify_latest_version(unique_dep_frequency, ecosystem, True)
+        latest_version_sync.submit(unique_dep_frequency, ecosystem, True, self.sync_cache)
         return {
             'stack_requests_count': total_stack_requests[ecosystem],
             'unique_dependencies_with_frequency':
@@ -360,11 +425,23 @@ class ReportHelper:
             obj_key = '{freq}/{report_name}.json'.format(
                 freq=frequency, report_name=report_name
             )
-            self.s3.store_json_content(content=template, obj_key=obj_key,
-                                       bucket_name=self.s3.report_bucket_name)
+            if not self.s3.store_json_stream(content=template, obj_key=obj_key,
+                                             bucket_name=self.s3.report_bucket_name):
+                return
+            # The next day ingestion check only needs the unknown deps of the report,
+            # a sidecar without its report would be taken for a report that does not exist
+            self.s3.store_json_content(
+                content=UnknownDepsReportHelper.build_sidecar(template),
+                obj_key=UnknownDepsReportHelper.get_sidecar_obj_key(obj_key),
+                bucket_name=self.s3.report_bucket_name)
         except Exception as e:
             logger.exception('Unable to store the report on S3. Reason: %r' % e)
 
+    def fill_cve_report(self, frequency, report_name, template, cve_report):
+        """Fill the CVE report into a saved report."""
+        template['stacks_summary']['cve_report'] = cve_report
+        self.save_result(frequency, report_name, template)
+
     def get_report_name(self, frequency, end_date):
         """Create a report name."""
         if frequency == 'monthly':
@@ -538,9 +615,16 @@ class ReportHelper:
                     self.populate_key_count(all_cve_list),
                 'total_average_response_time':
                     '{} ms'.format(total_response_time['all'] / len(template['stacks_details'])),
-                'cve_report': CVE().generate_cve_report(updated_on=start_date)
+                'cve_report': cve_report_provider.get_report(
+                    start_date, self.cve_report_cache, self.github_etag_cache)
             }
 
+            # The CVE report, or the part of it GitHub rate limited, is filled in later,
+            # the stacks collected to retrain the models are not saved as a report
+            if retrain is not True:
+                cve_report_provider.when_ready(
+                    start_date, partial(self.fill_cve_report, frequency, report_name, template))
+
             # monthly data collection on the 1st of every month
             if frequency == 'monthly':
                 self.collate_raw_data(unique_stacks_with_recurrence_count, 'monthly')
@@ -606,206 +690,8 @@ class ReportHelper:
         self.cursor.execute(query.as_string(self.conn) % (start_date, end_date))
         data = json.dumps(self.cursor.fetchall())
         result['EPV_DATA'] = data
-        return self.normalize_ingestion_data(start_date, end_date, result, frequency)
-
-    def generate_results(self, epvs, template, pkg_output, ver_output):
-        """Get package information from graph."""
-        template['ingestion_summary']['incorrect_latest_version'] = {}
-        template['ingestion_summary']['unknown_deps'] = {}
-        count = {}
-        latest_epvs = []
-        checked_pkgs = []
-        for epv in epvs:
-            eco = epv['ecosystem']
-            pkg = epv['name']
-            ver = epv['version']
-
-            # Add parameters to count the different params
-            if eco not in count:
-                count[eco] = {
-                    'incorrect_latest_versions': 0,
-                    'correct_latest_versions': 0,
-                    'ingested_in_graph': 0,
-                    'not_ingested_in_graph': 0
-                }
-            if eco not in template['ingestion_summary']['incorrect_latest_version']:
-                template['ingestion_summary']['incorrect_latest_version'][eco] = []
-                template['ingestion_summary']['unknown_deps'][eco] = []
-            pkg_data = pkg_output[eco + "@DELIM@" + pkg]
-            ver_data = ver_output[eco + "@DELIM@" + pkg + "@DELIM@" + ver]
-            actual_latest_ver = pkg_data['actual_latest_version']
-
-            # check if the package is publicly available
-            if actual_latest_ver:
-                known_latest_ver = pkg_data['known_latest_version']
-                if actual_latest_ver != known_latest_ver and (eco + "@DELIM@" + pkg
-                                                              not in checked_pkgs):
-                    checked_pkgs.append(eco + "@DELIM@" + pkg)
-                    tmp = {
-                        "package": pkg,
-                        "actual_latest_version": actual_latest_ver,
-                        "known_latest_version": known_latest_ver
-                    }
-                    template['ingestion_summary']['incorrect_latest_version'][eco].append(tmp)
-                    count[eco]['incorrect_latest_versions'] += 1
-
-                template['ingestion_details'][eco][pkg]['known_latest_version'] \
-                    = known_latest_ver
-                template['ingestion_details'][eco][pkg]['actual_latest_version'] \
-                    = actual_latest_ver
-                non_cve_version = pkg_data.get('non_cve_version', '')
-                if non_cve_version:
-                    template['ingestion_details'][eco][pkg]['non_cve_version'] \
-                        = non_cve_version
-                latest_json = {
-                    "ecosystem": eco,
-                    "name": pkg,
-                    "version": actual_latest_ver
-                }
-                latest_epvs.append(latest_json)
-
-                # Count the correct latest version EPVs
-                if actual_latest_ver == known_latest_ver:
-                    count[eco]['correct_latest_versions'] += 1
-
-                # Add to report if the EPV exist in the graph or not
-                template['ingestion_details'][eco][pkg][ver]['synced_to_graph'] = ver_data
-                if ver_data == "false":
-                    template['ingestion_summary']['unknown_deps'][eco].append(epv)
-                    count[eco]['not_ingested_in_graph'] += 1
-                else:
-                    count[eco]['ingested_in_graph'] += 1
-            else:
-                # Mark the package as private as the information is not present publicly
-                template['ingestion_details'][eco][pkg]['private_pkg'] = "true"
-
-        # For each ecosystem, calculate the %age accuracy
-        for eco in count:
-            correct = count[eco]['correct_latest_versions']
-            incorrect = count[eco]['incorrect_latest_versions']
-            # Calculate the %age of latest version accuracy
-            if correct != 0 or incorrect != 0:
-                count[eco]['latest_version_accuracy'] = round(((correct * 100) /
-                                                               (correct + incorrect)), 2)
-
-            correct = count[eco]['ingested_in_graph']
-            incorrect = count[eco]['not_ingested_in_graph']
-            # Calculate the %age of successful ingestion
-            if correct != 0 or incorrect != 0:
-                count[eco]['ingestion_accuracy'] = round(((correct * 100) /
-                                                          (correct + incorrect)), 2)
-
-            # Rectify the latest versions only if present
-            if count[eco]['incorrect_latest_versions'] != 0:
-                summary = template['ingestion_summary']
-                logger.info("Information related to incorrect latest version --")
-                logger.info(summary['incorrect_latest_version'][eco])
-                rectify_latest_version(summary['incorrect_latest_version'][eco], eco)
-        template['ingestion_summary']['stats'] = count
-        return template, latest_epvs
-
-    def check_latest_node(self, latest_epvs, template):
-        """Get if latest node is present in graph."""
-        graph_output = generate_report_for_unknown_epvs(latest_epvs)
-        missing_latest = {}
-        for epv in latest_epvs:
-            eco = epv['ecosystem']
-            pkg = epv['name']
-            ver = epv['version']
-            output = graph_output[eco + "@DELIM@" + pkg + "@DELIM@" + ver]
-            template['ingestion_details'][eco][pkg]['latest_node_in_graph'] = output
-
-            # If the EPV is missing in graph, add it to the summary
-            if output == "false":
-                if eco not in missing_latest:
-                    missing_latest[eco] = []
-                tmp = {
-                    "package": pkg,
-                    "version": ver
-                }
-                missing_latest[eco].append(tmp)
-        template['ingestion_summary']['missing_latest_node'] = missing_latest
-        return template
-
-    def populate_default_information(self, epv_data, template):
-        """To populate the default information in the template."""
-        epvs = []
-        ing_details = {}
-        for epv in epv_data:
-            eco = epv[0]
-            pkg = epv[1]
-            ver = epv[2]
-            epv_template = {
-                'ecosystem': eco,
-                'name': pkg,
-                'version': ver
-            }
-            epvs.append(epv_template)
-
-            # Add eco key in json if missing
-            if eco not in ing_details:
-                ing_details[eco] = {}
-
-            # Add pkg key in json if missing
-            if pkg not in ing_details[eco]:
-                ing_details[eco][pkg] = {}
-
-            # Add version key in json if missing
-            if ver not in ing_details[eco][pkg]:
-                ing_details[eco][pkg][ver] = {}
-
-        # Add the EPV information to the template
-        template['ingestion_details'] = ing_details
-        return template, epvs
-
-    def normalize_ingestion_data(self, start_date, end_date, ingestion_data, frequency='daily'):
-        """Normalize worker data for reporting."""
-        logger.info("Normalize Ingestion Data started")
-        report_type = 'ingestion-data'
-        if frequency == 'monthly':
-            report_name = dt.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m')
-        else:
-            report_name = dt.strptime(end_date, '%Y-%m-%d').strftime('%Y-%m-%d')
-
-        template = {
-            'report': {
-                'from': start_date,
-                'to': end_date,
-                'generated_on': dt.now().isoformat('T')
-            },
-            'ingestion_summary': {},
-            'ingestion_details': {}
-        }
-
-        epv_data = ingestion_data['EPV_DATA']
-        epv_data = json.loads(epv_data)
-
-        # Populate the default template with EPV info
-        template, epvs = self.populate_default_information(epv_data, template)
-
-        logger.info("Fetching details of the latest version for the epvs")
-        today = dt.today()
-        pkg_output = generate_report_for_latest_version(epvs, today)
-        logger.info("Fetching details of the unknown packages for the epvs")
-        ver_output = generate_report_for_unknown_epvs(epvs)
-
-        # Call the function to add the package information to the template
-        template, latest_epvs = self.generate_results(epvs, template, pkg_output, ver_output)
-
-        # Call the function to get the availability of latest node
-        logger.info("Checking if latest node exists in graph")
-        template = self.check_latest_node(latest_epvs, template)
-
-        # Saving the final report in the relevant S3 bucket
-        try:
-            obj_key = '{type}/epv/{report_name}.json'.format(
-                type=report_type, report_name=report_name
-            )
-            self.s3.store_json_content(content=template, obj_key=obj_key,
-                                       bucket_name=self.s3.report_bucket_name)
-        except Exception as e:
-            logger.exception('Unable to store the report on S3. Reason: %r' % e)
-        return template
+        return self.ingestion_helper.normalize_ingestion_data(start_date, end_date, result,
+                                                              frequency)
 
     def get_report(self, start_date, end_date, frequency='daily', retrain=False):
         """Generate the stacks report."""
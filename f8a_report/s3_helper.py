@@ -1,14 +1,62 @@
 """Various utility functions related to S3 storage."""
 
+import gzip
+import hashlib
 import json
 import os
 import logging
+import threading
+import zlib
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from werkzeug.exceptions import BadRequest
 
+try:
+    # The streaming reads fall back to parsing the whole object where it is not installed
+    import ijson
+except ImportError:
+    ijson = None
+
 logger = logging.getLogger(__file__)
 
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+S3_TRANSFER_WORKERS = int(os.getenv('S3_TRANSFER_WORKERS', 8))
+# Directory keeping the objects read with cache=True across runs, in memory only when unset
+S3_CACHE_DIR = os.getenv('S3_CACHE_DIR')
+# Store the JSON objects gzip compressed and without whitespace
+S3_COMPRESS_JSON = os.getenv('S3_COMPRESS_JSON', 'False') in ('True', 'true', '1')
+# S3 requires all the parts of a multipart upload but the last one to be at least 5 MB
+S3_MULTIPART_PART_SIZE = max(int(os.getenv('S3_MULTIPART_PART_SIZE', 8 * 1024 * 1024)),
+                             5 * 1024 * 1024)
+
+_s3_resources = {}
+_s3_resources_lock = threading.Lock()
+
+# Decoded objects read with cache=True and their ETags, shared by all the helpers
+_cached_objects = {}
+_cached_objects_lock = threading.Lock()
+
+
+def get_s3_resource(region_name, aws_access_key_id, aws_secret_access_key):
+    """Get the S3 resource shared by all the helpers using the same credentials."""
+    key = (region_name, aws_access_key_id, aws_secret_access_key)
+    if aws_access_key_id is None:
+        # boto3 resolves the default credentials when the resource is created
+        key += (os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY'))
+    with _s3_resources_lock:
+        if key not in _s3_resources:
+            # boto3 sessions are not thread safe, so each resource gets its own
+            session = boto3.session.Session()
+            _s3_resources[key] = session.resource(
+                's3', region_name=region_name,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+        return _s3_resources[key]
+
 
 class S3Helper:
     """Helper class for storing reports to S3."""
@@ -55,67 +103,285 @@ class S3Helper:
     def s3_client(self, bucket_name):
         """Provide s3 client for each bucket."""
         if bucket_name == os.environ.get('REPORT_BUCKET_NAME'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_report_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_report_bucket)
+            credentials = (self.aws_s3_access_key_report_bucket,
+                           self.aws_s3_secret_access_key_report_bucket)
         elif bucket_name == os.getenv('PYPI_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_pypi_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_pypi_bucket)
+            credentials = (self.aws_s3_access_key_pypi_bucket,
+                           self.aws_s3_secret_access_key_pypi_bucket)
         elif bucket_name == os.getenv('GOLANG_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_golang_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_golang_bucket)
+            credentials = (self.aws_s3_access_key_golang_bucket,
+                           self.aws_s3_secret_access_key_golang_bucket)
         elif bucket_name == os.getenv('MAVEN_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_mvn_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_mvn_bucket)
+            credentials = (self.aws_s3_access_key_mvn_bucket,
+                           self.aws_s3_secret_access_key_mvn_bucket)
         elif bucket_name == os.getenv('NPM_MODEL_BUCKET'):
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key_npm_bucket,
-                                aws_secret_access_key=self.aws_s3_secret_access_key_npm_bucket)
+            credentials = (self.aws_s3_access_key_npm_bucket,
+                           self.aws_s3_secret_access_key_npm_bucket)
         else:
-            s3 = boto3.resource('s3', region_name=self.region_name,
-                                aws_access_key_id=self.aws_s3_access_key,
-                                aws_secret_access_key=self.aws_s3_secret_access_key)
-        return s3
+            credentials = (self.aws_s3_access_key, self.aws_s3_secret_access_key)
+        return get_s3_resource(self.region_name, *credentials)
 
-    def store_json_content(self, content, bucket_name, obj_key):
-        """Store the report content to the S3 storage."""
-        s3 = self.s3_client(bucket_name)
+    def store_json_content(self, content, bucket_name, obj_key, compress=None):
+        """Store the report content to the S3 storage.
+
+        With compress, or S3_COMPRESS_JSON when it is not given, the content is stored
+        as compact JSON with gzip content encoding.
+
+        :return bool, whether the content was stored
+        """
+        # Unlike the resource, the client is thread safe and can be used by put_many
+        client = self.s3_client(bucket_name).meta.client
+        if compress is None:
+            compress = S3_COMPRESS_JSON
         try:
             logger.info('Storing the report into the S3 file %s' % obj_key)
-            s3.Object(bucket_name, obj_key).put(
-                Body=json.dumps(content, indent=2).encode('utf-8'))
+            if compress:
+                body = json.dumps(content, separators=(',', ':')).encode('utf-8')
+                client.put_object(Bucket=bucket_name, Key=obj_key, Body=gzip.compress(body),
+                                  ContentEncoding='gzip', ContentType='application/json')
+            else:
+                client.put_object(Bucket=bucket_name, Key=obj_key,
+                                  Body=json.dumps(content, indent=2).encode('utf-8'))
+            return True
         except Exception as e:
             logger.exception('%r' % e)
+            return False
 
-    def read_json_object(self, bucket_name, obj_key):
-        """Get the report json object found on the S3 bucket."""
-        s3 = self.s3_client(bucket_name)
+    def put_many(self, objects, compress=None):
+        """Store several JSON objects concurrently.
+
+        :param objects: list, (bucket name, object key, content) tuples
+        :param compress: bool, passed on to store_json_content
+        :return dict, whether each object was stored keyed by (bucket name, object key)
+        """
+        with ThreadPoolExecutor(max_workers=S3_TRANSFER_WORKERS) as executor:
+            stored = executor.map(
+                lambda obj: self.store_json_content(obj[2], obj[0], obj[1], compress), objects)
+            return {(bucket_name, obj_key): status
+                    for (bucket_name, obj_key, _), status in zip(objects, stored)}
+
+    def get_many(self, objects, cache=False):
+        """Read several JSON objects concurrently.
+
+        :param objects: list, (bucket name, object key) tuples
+        :param cache: bool, passed on to read_json_object
+        :return dict, content of each object, None when it could not be read,
+            keyed by (bucket name, object key)
+        """
+        def read(obj):
+            try:
+                return self.read_json_object(*obj, cache=cache)
+            except Exception as e:
+                logger.exception('Unable to read %s: %r' % (obj[1], e))
+                return None
+
+        with ThreadPoolExecutor(max_workers=S3_TRANSFER_WORKERS) as executor:
+            return dict(zip(objects, executor.map(read, objects)))
+
+    def store_json_stream(self, content, bucket_name, obj_key, compress=None):
+        """Store the report content to the S3 storage without serializing it at once.
+
+        The content is encoded incrementally and sent as a part of a multipart upload each
+        time S3_MULTIPART_PART_SIZE bytes are buffered, content smaller than a part is put
+        in a single call. The format is the same as with store_json_content.
+
+        :return bool, whether the content was stored
+        """
+        client = self.s3_client(bucket_name).meta.client
+        if compress is None:
+            compress = S3_COMPRESS_JSON
+        if compress:
+            encoder = json.JSONEncoder(separators=(',', ':'))
+            # wbits=31 writes a gzip container
+            compressor = zlib.compressobj(wbits=31)
+            extra_args = {'ContentEncoding': 'gzip', 'ContentType': 'application/json'}
+        else:
+            encoder = json.JSONEncoder(indent=2)
+            compressor = None
+            extra_args = {}
+        upload_id = None
+        parts = []
+        buffer = bytearray()
+        try:
+            logger.info('Streaming the report into the S3 file %s' % obj_key)
+            for chunk in encoder.iterencode(content):
+                data = chunk.encode('utf-8')
+                buffer += compressor.compress(data) if compressor else data
+                if len(buffer) < S3_MULTIPART_PART_SIZE:
+                    continue
+                if upload_id is None:
+                    upload_id = client.create_multipart_upload(
+                        Bucket=bucket_name, Key=obj_key, **extra_args)['UploadId']
+                parts.append(self.upload_part(client, bucket_name, obj_key, upload_id,
+                                              len(parts) + 1, buffer))
+                buffer = bytearray()
+            if compressor:
+                buffer += compressor.flush()
+            if upload_id is None:
+                client.put_object(Bucket=bucket_name, Key=obj_key, Body=bytes(buffer),
+                                  **extra_args)
+                return True
+            parts.append(self.upload_part(client, bucket_name, obj_key, upload_id,
+                                          len(parts) + 1, buffer))
+            client.complete_multipart_upload(Bucket=bucket_name, Key=obj_key,
+                                             UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+            return True
+        except Exception as e:
+            logger.exception('%r' % e)
+            if upload_id is not None:
+                try:
+                    client.abort_multipart_upload(Bucket=bucket_name, Key=obj_key,
+                                                  UploadId=upload_id)
+                except Exception as e:
+                    logger.exception('Unable to abort the upload of %s: %r' % (obj_key, e))
+            return False
+
+    @staticmethod
+    def upload_part(client, bucket_name, obj_key, upload_id, part_number, data):
+        """Upload one part of a multipart upload."""
+        resp = client.upload_part(Bucket=bucket_name, Key=obj_key, UploadId=upload_id,
+                                  PartNumber=part_number, Body=bytes(data))
+        return {'ETag': resp['ETag'], 'PartNumber': part_number}
+
+    @staticmethod
+    def get_cache_path(bucket_name, obj_key):
+        """Get the path of the on-disk copy of an object, without extension."""
+        name = hashlib.sha1('{b}/{k}'.format(b=bucket_name, k=obj_key).encode('utf-8'))
+        return os.path.join(S3_CACHE_DIR, name.hexdigest())
+
+    def get_cached_object(self, bucket_name, obj_key):
+        """Get the ETag and decoded content of the cached copy of an object, if any."""
+        with _cached_objects_lock:
+            cached = _cached_objects.get((bucket_name, obj_key))
+        if cached is not None or not S3_CACHE_DIR:
+            return cached
+        path = self.get_cache_path(bucket_name, obj_key)
+        try:
+            with open(path + '.etag') as etag_file, open(path + '.json', 'rb') as json_file:
+                cached = (etag_file.read(), json.loads(json_file.read().decode('utf-8')))
+        except (OSError, ValueError):
+            return None
+        with _cached_objects_lock:
+            return _cached_objects.setdefault((bucket_name, obj_key), cached)
+
+    def cache_object(self, bucket_name, obj_key, etag, body, content):
+        """Keep the decoded content of an object, and its body on disk if configured."""
+        with _cached_objects_lock:
+            _cached_objects[(bucket_name, obj_key)] = (etag, content)
+        if not S3_CACHE_DIR:
+            return
+        path = self.get_cache_path(bucket_name, obj_key)
         try:
-            obj = s3.Object(bucket_name, obj_key)
-            result = json.loads(obj.get()['Body'].read().decode('utf-8'))
+            os.makedirs(S3_CACHE_DIR, exist_ok=True)
+            # Write to temporary files first so that a crash never leaves a torn copy
+            for ext, data, mode in (('.json', body, 'wb'), ('.etag', etag, 'w')):
+                with open(path + ext + '.tmp', mode) as f:
+                    f.write(data)
+            os.replace(path + '.json.tmp', path + '.json')
+            os.replace(path + '.etag.tmp', path + '.etag')
+        except OSError as e:
+            logger.error('Unable to cache %s on disk: %r' % (obj_key, e))
+
+    def read_json_object(self, bucket_name, obj_key, cache=False):
+        """Get the report json object found on the S3 bucket, compressed or not.
+
+        With cache the decoded object is kept and shared by all the helpers of the process,
+        it is revalidated with its ETag on every read. Callers must not modify it.
+        """
+        client = self.s3_client(bucket_name).meta.client
+        cached = self.get_cached_object(bucket_name, obj_key) if cache else None
+        try:
+            extra_args = {'IfNoneMatch': cached[0]} if cached else {}
+            obj = client.get_object(Bucket=bucket_name, Key=obj_key, **extra_args)
+            body = obj['Body'].read()
+            if 'gzip' in obj.get('ContentEncoding', '').split(','):
+                body = gzip.decompress(body)
+            result = json.loads(body.decode('utf-8'))
+            if cache:
+                self.cache_object(bucket_name, obj_key, obj['ETag'], body, result)
             return result
         except ClientError as e:
-            if e.response['Error']['Code'] == 'NoSuchKey':
-                logger.exception('No Such Key %s exists' % obj_key)
-            elif e.response['Error']['Code'] == 'NoSuchBucket':
-                logger.exception('ERROR - No Such Bucket %s exists' % bucket_name)
+            if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+                return cached[1]
+            self.log_read_error(e, bucket_name, obj_key)
+            return None
+
+    @staticmethod
+    def log_read_error(e, bucket_name, obj_key):
+        """Log the reason an object could not be read."""
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            logger.exception('No Such Key %s exists' % obj_key)
+        elif e.response['Error']['Code'] == 'NoSuchBucket':
+            logger.exception('ERROR - No Such Bucket %s exists' % bucket_name)
+        else:
+            logger.exception('%r' % e)
+
+    @contextmanager
+    def open_json_object(self, bucket_name, obj_key):
+        """Open the body of a JSON object for reading, decompressing it on the fly."""
+        client = self.s3_client(bucket_name).meta.client
+        obj = client.get_object(Bucket=bucket_name, Key=obj_key)
+        body = obj['Body']
+        try:
+            if 'gzip' in obj.get('ContentEncoding', '').split(','):
+                yield gzip.GzipFile(fileobj=body, mode='rb')
             else:
-                logger.exception('%r' % e)
+                yield body
+        finally:
+            # Drop the connection of a partially read body instead of reusing it
+            body.close()
+
+    def read_json_path(self, bucket_name, obj_key, path):
+        """Get the value found at a key path of a JSON object on the S3 bucket.
+
+        With ijson only that value is built, the rest of the object is skipped while it is
+        downloaded.
+
+        :param path: str, dot separated keys leading to the value
+        :return the value, None when the object or the path do not exist
+        """
+        try:
+            with self.open_json_object(bucket_name, obj_key) as body:
+                if ijson is not None:
+                    return next(ijson.items(body, path, use_float=True), None)
+                return self.get_json_path(json.load(body), path)
+        except ClientError as e:
+            self.log_read_error(e, bucket_name, obj_key)
             return None
 
-    def list_objects(self, bucket_name, frequency):
-        """Fetch the list of objects found on the S3 bucket."""
-        s3 = self.s3_client(bucket_name)
-        prefix = '{dp}/{freq}'.format(dp=self.deployment_prefix, freq=frequency)
-        res = {'objects': []}
+    @staticmethod
+    def get_json_path(content, path):
+        """Get the value found at the dot separated key path of decoded JSON content."""
+        for key in filter(None, path.split('.')):
+            if not isinstance(content, dict):
+                return None
+            content = content.get(key)
+        return content
+
+    def iter_objects(self, bucket_name, frequency, start=None, end=None):
+        """Lazily yield the keys of the objects found on the S3 bucket, page by page.
+
+        Report names start with their date, so only the keys between start and end are
+        listed: listing starts after start and stops at the first name past end.
+
+        :param start: str, first name to list, e.g. '2020-01-01' for daily reports
+        :param end: str, last name to list, compared with as many characters of the names
+        """
+        client = self.s3_client(bucket_name).meta.client
+        # The trailing slash keeps e.g. daily from matching the keys of a daily-v2 folder
+        prefix = '{dp}/{freq}/'.format(dp=self.deployment_prefix, freq=frequency)
+        extra_args = {'StartAfter': prefix + start} if start else {}
+        paginator = client.get_paginator('list_objects_v2')
 
         try:
-            for obj in s3.Bucket(bucket_name).objects.filter(Prefix=prefix):
-                if os.path.basename(obj.key) != '':
-                    res['objects'].append(obj.key)
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **extra_args):
+                for obj in page.get('Contents', []):
+                    name = os.path.basename(obj['Key'])
+                    if end and name[:len(end)] > end:
+                        return
+                    if name != '':
+                        yield obj['Key']
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
                 logger.exception('ERROR - No Such Key %s exists' % prefix)
@@ -124,7 +390,9 @@ class S3Helper:
             else:
                 logger.exception('%r' % e)
 
-        return res
+    def list_objects(self, bucket_name, frequency, start=None, end=None):
+        """Fetch the list of objects found on the S3 bucket."""
+        return {'objects': list(self.iter_objects(bucket_name, frequency, start, end))}
 
     def store_file_object(self, file_path, bucket_name, file_name):
         """Store the manifest file to the S3 storage."""
@@ -3,11 +3,18 @@
 import os
 import logging
 import requests as requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from s3_helper import S3Helper
+from cache_helper import get_persistent_cache
 from datetime import datetime as dt
 
 logger = logging.getLogger(__file__)
 
+SENTRY_WORKERS = int(os.getenv('SENTRY_WORKERS', 8))
+SENTRY_TIMEOUT = float(os.getenv('SENTRY_TIMEOUT', 60))
+SENTRY_MAX_PAGES = int(os.getenv('SENTRY_MAX_PAGES', 100))
+
 
 class SentryReportHelper:
     """Various functions related to sentry reporting."""
@@ -20,23 +27,42 @@ class SentryReportHelper:
             'SENTRY_API_ISSUES', '/api/0/projects/sentry/fabric8-analytics-production/issues/')
         self.sentry_api_tags = self.sentry_url + os.getenv('SENTRY_API_TAGS', '/api/0/issues/')
         self.sentry_token = os.getenv('SENTRY_AUTH_TOKEN', '')
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer {token}'.format(token=self.sentry_token)
+        adapter = HTTPAdapter(pool_maxsize=SENTRY_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Latest events of the issues, which only change when the issue is seen again
+        self.events_cache = get_persistent_cache(
+            'sentry-events', s3=self.s3,
+            ttl=int(os.getenv('SENTRY_EVENTS_CACHE_TTL', 7 * 24 * 3600)))
+
+    def iter_sentry_issues(self):
+        """Iterate over the issues of the last 24 hours, following the Link cursors."""
+        url = self.sentry_api_issues + '?statsPeriod=24h'
+        for _ in range(SENTRY_MAX_PAGES):
+            resp = self.session.get(url=url, timeout=SENTRY_TIMEOUT)
+            # Checking for status code
+            # If status is not success, log it as an error
+            if resp.status_code != 200:
+                logger.error('Error received from Sentry API \n {resp}'.format(resp=resp.text))
+                resp.raise_for_status()
+            yield from resp.json()
+            next_page = resp.links.get('next', {})
+            if next_page.get('results') != 'true':
+                return
+            url = next_page['url']
+        logger.error('Sentry issues truncated to {n} pages'.format(n=SENTRY_MAX_PAGES))
 
     def retrieve_sentry_logs(self, start_date, end_date):
         """Retrieve results for selected worker from RDB."""
         result = {}
         try:
             # Invoke Sentry API to run the error collection
-            auth = 'Bearer {token}'.format(token=self.sentry_token)
-            resp = requests.get(url=self.sentry_api_issues + '?statsPeriod=24h',
-                                headers={"Authorization": auth})
-            # Checking for status code
-            # If status is not success, log it as an error
-            if resp.status_code == 200:
-                logger.info('Successfully invoked Sentry API')
-                # associate the retrieved data to result
-                result = self.normalize_sentry_data(start_date, end_date, resp.json())
-            else:
-                logger.error('Error received from Sentry API \n {resp}'.format(resp=resp.json()))
+            errorlogs = list(self.iter_sentry_issues())
+            logger.info('Successfully invoked Sentry API')
+            # associate the retrieved data to result
+            result = self.normalize_sentry_data(start_date, end_date, errorlogs)
         except requests.exceptions.RequestException as e:
             logger.error('Unable to invoke Sentry API. Reason: %r' % e)
         except requests.exceptions.Timeout as e:
@@ -50,17 +76,32 @@ class SentryReportHelper:
         result = {
             "error_report": {}
         }
+        # Only the issues that are new or were seen again since the last run need their
+        # latest event, retrieve them concurrently
+        keys = [(item.get('id', ''), item.get('lastSeen', '')) for item in errorlogs]
+        all_events = [self.events_cache.get(key) for key in keys]
+        missing = [i for i, events in enumerate(all_events) if events is None]
+        with ThreadPoolExecutor(max_workers=SENTRY_WORKERS) as executor:
+            retrieved = executor.map(lambda i: self.retrieve_events(keys[i][0]), missing)
+            for i, events in zip(missing, retrieved):
+                all_events[i] = events
+                if 'error' not in events:
+                    self.events_cache.set(keys[i], events)
+        self.events_cache.log_stats()
+        failed = {}
         # Iterating all the error logs
-        try:
-            for item in errorlogs:
+        for item, events in zip(errorlogs, all_events):
+            if 'error' in events:
+                failed[item.get('id')] = events['error']
+            try:
                 errors = {}
-                events = self.retrieve_events(item['id'])
                 errors['id'] = item['id']
                 errors['last_seen'] = item['lastSeen']
                 errors[events['pods_impacted']] = item['metadata']['type'] + ": " + \
                     item['metadata']['value'] if item['metadata'].get('type')\
                     else item['metadata']['title']
                 errors['stacktrace'] = events['stacktrace']
+                errors['frames'] = events.get('frames', [])
                 # Detecting the endpoint services
                 server_name = "-".join(events['pods_impacted'].split("-")[:-2])
                 result['error_report'][server_name] = result['error_report'][server_name] \
@@ -71,21 +112,61 @@ class SentryReportHelper:
                 if not result['error_report'][server_name].get('errors'):
                     result['error_report'][server_name]['errors'] = []
                 result['error_report'][server_name]['errors'].append(errors)
-        except KeyError as e:
-            logger.error('Key not found while parsing. Reason: %r' % e)
-            # Saving the final report in the relevant S3 bucket
+            except KeyError as e:
+                failed.setdefault(item.get('id'), 'Key not found while parsing. Reason: %r' % e)
+        if failed:
+            logger.error('Errors in {n} of {total} Sentry issues: {failed}'.format(
+                n=len(failed), total=len(errorlogs), failed=failed))
 
+        # Saving the final report in the relevant S3 bucket
         try:
             obj_key = '{type}/{report_name}.json'.format(
                 type=report_type, report_name=report_name
             )
             self.s3.store_json_content(content=result, obj_key=obj_key,
                                        bucket_name=self.s3.report_bucket_name)
+            self.events_cache.save()
         except Exception as e:
             logger.exception('Unable to store the report on S3. Reason: %r' % e)
 
         return result
 
+    @staticmethod
+    def extract_frames(entries):
+        """Extract the frames of all the exceptions of an event.
+
+        :param entries: list, entries of the Sentry event
+        :return list, frames with their file, line, function and statement
+        """
+        frames = []
+        for entry in entries:
+            if entry.get('type') != 'exception':
+                continue
+            for value in entry.get('data', {}).get('values') or []:
+                for frame in (value.get('stacktrace') or {}).get('frames') or []:
+                    line = frame.get('lineNo')
+                    # The context holds the [line number, statement] pairs around the line
+                    statement = next((context[1] for context in frame.get('context') or []
+                                      if context[0] == line), None)
+                    frames.append({
+                        'file': frame.get('filename'),
+                        'line': line,
+                        'function': frame.get('function'),
+                        'statement': statement
+                    })
+        return frames
+
+    @staticmethod
+    def render_stacktrace(frames):
+        """Render the frames as a single line stacktrace."""
+        rendered = []
+        for frame in frames:
+            rendered.append('File {file}, Line {line}, Function {function}'.format(**frame))
+            if frame['statement'] is not None:
+                rendered.append(', Statement ' + frame['statement'])
+            rendered.append(' || ')
+        return ''.join(rendered)
+
     def retrieve_events(self, issue_id):
         """Retrieve results for issue events."""
         events = {'stacktrace': ''}
@@ -93,20 +174,18 @@ class SentryReportHelper:
 
         try:
             # Invoke Sentry API to run the event collection
-            auth = 'Bearer {token}'.format(token=self.sentry_token)
-            resp = requests.get(url=self.sentry_api_tags + issue_id + '/events/latest/',
-                                headers={"Authorization": auth})
+            resp = self.session.get(url=self.sentry_api_tags + issue_id + '/events/latest/',
+                                    timeout=SENTRY_TIMEOUT)
             # Check for status code
-            # If status is not success, log it as an error
+            # If status is not success, record it as the error of the issue
             if resp.status_code == 200:
-                logger.info('Successfully invoked Sentry API \n {resp}'.format(resp=resp.json()))
                 output = resp.json()
             else:
-                logger.error('Error received from Sentry API \n {resp}'.format(resp=resp.json()))
-        except requests.exceptions.RequestException as e:
-            logger.error('Unable to invoke Sentry API3. Reason: %r' % e)
-        except requests.exceptions.Timeout as e:
-            logger.error('Timeout occured while invoking Sentry API. Reason: %r' % e)
+                events['error'] = 'Sentry API returned HTTP {code}'.format(code=resp.status_code)
+                return events
+        except (ValueError, requests.exceptions.RequestException) as e:
+            events['error'] = 'Unable to invoke Sentry API. Reason: %r' % e
+            return events
 
         try:
             # retrieving server name info
@@ -115,26 +194,11 @@ class SentryReportHelper:
                     events['pods_impacted'] = item['value']
                     break
             # Collecting stacktrace for each frames
-            if output['entries'][1]['type'] == 'exception':
-                for frames in output['entries'][1]['data']['values'][0]['stacktrace']['frames']:
-                    stacktrace = 'File ' + frames['filename'] + ', Line ' + \
-                                 str(frames['lineNo']) + ', Function ' + \
-                                 frames['function']
-                    # Collecting stacktrace for each line Nos
-                    for context in frames['context']:
-                        if frames['lineNo'] in context:
-                            stacktrace = stacktrace + ', Statement ' + \
-                                         context[1] + ' || '
-                            break
-                    else:
-                        stacktrace = stacktrace + ' || '
-                    events['stacktrace'] = events['stacktrace'] + stacktrace
-            else:
-                events['stacktrace'] = 'Not Available'
+            events['frames'] = self.extract_frames(output['entries'])
+            events['stacktrace'] = self.render_stacktrace(events['frames']) \
+                if events['frames'] else 'Not Available'
         except KeyError as e:
-            logger.error('Key not found while parsing. Reason: %r' % e)
+            events['error'] = 'Key not found while parsing. Reason: %r' % e
         except IndexError as e:
-            logger.error('Index not found while parsing. Reason: %r' % e)
-        except NameError as e:
-            logger.error('Name not found while parsing. Reason: %r' % e)
+            events['error'] = 'Index not found while parsing. Reason: %r' % e
         return events
@@ -7,6 +7,8 @@ import logging
 
 logger = logging.getLogger(__file__)
 
+ECOSYSTEMS = ['npm', 'maven', 'pypi']
+
 
 class UnknownDepsReportHelper:
     """Utility functions for reporting ingestion of reported unknown dependencies.
@@ -14,9 +16,10 @@ class UnknownDepsReportHelper:
     Lists Previous Day Unknown Dependencies from Previous Day Daily Report
     """
 
-    def __init__(self):
+    def __init__(self, epv_cache=None):
         """Init method for UnknownDepReportHelper."""
         self.s3 = S3Helper()
+        self.epv_cache = epv_cache
 
     @staticmethod
     def get_obj_key(past_date):
@@ -24,11 +27,24 @@ class UnknownDepsReportHelper:
         logger.info("Building key for v1.")
         return f'daily/{past_date}.json'
 
+    @staticmethod
+    def get_sidecar_obj_key(obj_key):
+        """Get s3 object key of the unknown deps saved along with a report."""
+        return f'unknown-deps/{obj_key}'
+
+    @staticmethod
+    def build_sidecar(report):
+        """Keep only the unknown deps of each ecosystem of a report."""
+        stacks_summary = report.get('stacks_summary') or {}
+        return {'stacks_summary': {
+            eco: {'unique_unknown_dependencies_with_frequency': stacks_summary[eco].get(
+                'unique_unknown_dependencies_with_frequency', {})}
+            for eco in ECOSYSTEMS if isinstance(stacks_summary.get(eco), dict)}}
+
     def get_unknown_list(self, result):
         """Create a list of unknown deps."""
-        ecosystem_list = ['npm', 'maven', 'pypi']
         unknown_deps_list = {}
-        for eco in ecosystem_list:
+        for eco in ECOSYSTEMS:
             deps = []
             if result:
                 unknown_deps = result.get('stacks_summary', {}).get(eco, {}). \
@@ -50,10 +66,15 @@ class UnknownDepsReportHelper:
         today = dt.today()
         past_date = (today - timedelta(days=1)).strftime('%Y-%m-%d')
 
-        # Get the report of the previous date
+        # Get the unknown deps saved along with the report of the previous date
         past_obj_key = self.get_obj_key(past_date)
         result = self.s3.read_json_object(bucket_name=self.s3.report_bucket_name,
-                                          obj_key=past_obj_key)
+                                          obj_key=self.get_sidecar_obj_key(past_obj_key))
+        if result is None:
+            # Fall back to the summary of the full report, saved without the unknown deps
+            stacks_summary = self.s3.read_json_path(bucket_name=self.s3.report_bucket_name,
+                                                    obj_key=past_obj_key, path='stacks_summary')
+            result = {'stacks_summary': stacks_summary} if stacks_summary else None
 
         # Return the list of unknown dependencies found
         return self.get_unknown_list(result)
@@ -66,7 +87,9 @@ class UnknownDepsReportHelper:
 
         # Check for the known one's among those
         for eco, deps in unknown_deps.items():
-            ingestion_report[eco] = find_ingested_epv(eco, deps)
+            ingestion_report[eco] = find_ingested_epv(eco, deps, self.epv_cache)
+        if self.epv_cache is not None:
+            self.epv_cache.save()
         # Report the ingested repositories
         return ingestion_report
 
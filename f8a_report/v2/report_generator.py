@@ -18,7 +18,8 @@
 
 import logging
 import json
-from cve_helper import CVE
+from functools import partial
+from cve_helper import cve_report_provider
 from datetime import datetime as dt
 from v2.db_gateway import ReportQueries
 from unknown_deps_report_helper import UnknownDepsReportHelperV2
@@ -206,7 +207,9 @@ class StackReportBuilder():
                 self.report_helper.populate_key_count(self.all_cve_list),
             'total_average_response_time': '{} ms'.format(
                 self.total_response_time['all'] / len(report_content['stacks_details'])),
-            'cve_report': CVE().generate_cve_report(updated_on=self.start_date)
+            'cve_report': cve_report_provider.get_report(
+                self.start_date, self.report_helper.cve_report_cache,
+                self.report_helper.github_etag_cache)
         }
         ecosystem_summary = {ecosystem: self.report_helper.get_ecosystem_summary(
             ecosystem, self.total_stack_requests,
@@ -258,11 +261,18 @@ class StackReportBuilder():
             if 'license' in lic_dict:
                 self.unknown_licenses.append(lic_dict['license'])
 
-        unknown_deps_ingestion_report = UnknownDepsReportHelperV2().get_current_ingestion_status()
+        unknown_deps_ingestion_report = UnknownDepsReportHelperV2(
+            epv_cache=self.report_helper.epv_cache).get_current_ingestion_status()
 
         report_content['stacks_summary'] = self.build_report_summary(
             unknown_deps_ingestion_report, report_content)
 
+        # The CVE report, or the part of it GitHub rate limited, is filled in later,
+        # the stacks collected to retrain the models are not saved as a report
+        if not retrain:
+            cve_report_provider.when_ready(self.start_date, partial(
+                self.fill_cve_report, frequency, report_name, report_content))
+
         if frequency == 'monthly':
             # monthly data collection on the 1st of every month
             self.report_helper.collate_raw_data(self.unique_stacks_with_recurrence_count, frequency)
@@ -321,6 +331,11 @@ class StackReportBuilder():
         self.save_worker_result_to_s3(frequency, report_name, report_content)
         return report_content
 
+    def fill_cve_report(self, frequency, report_name, report_content, cve_report):
+        """Fill the CVE report into a saved report."""
+        report_content['stacks_summary']['cve_report'] = cve_report
+        self.save_worker_result_to_s3(frequency, report_name, report_content)
+
     @staticmethod
     def save_worker_result_to_s3(frequency, report_name, content) -> bool:
         """Save worker result in S3 bucket.
@@ -334,7 +349,13 @@ class StackReportBuilder():
         try:
             s3 = S3Helper()
             obj_key = f'v2/{frequency}/{report_name}.json'
-            s3.store_json_content(content=content, obj_key=obj_key,
+            if not s3.store_json_stream(content=content, obj_key=obj_key,
+                                        bucket_name=s3.report_bucket_name):
+                return False
+            # The next day ingestion check only needs the unknown deps of the report,
+            # a sidecar without its report would be taken for a report that does not exist
+            s3.store_json_content(content=UnknownDepsReportHelperV2.build_sidecar(content),
+                                  obj_key=UnknownDepsReportHelperV2.get_sidecar_obj_key(obj_key),
                                   bucket_name=s3.report_bucket_name)
             logger.info(f"Successfully saved report in {obj_key}.")
             return True
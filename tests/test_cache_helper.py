@@ -0,0 +1,79 @@
+"""Tests for classes from cache_helper module."""
+
+from f8a_report.cache_helper import PersistentCache, get_persistent_cache
+from f8a_report.s3_helper import S3Helper
+from moto import mock_s3
+from unittest import mock
+import boto3
+import os
+import pytest
+
+BUCKET = os.environ.get('REPORT_BUCKET_NAME')
+
+
+def test_get_and_set():
+    """Test that stored values are returned and counted as hits."""
+    cache = PersistentCache('test')
+    assert cache.get(('npm', 'lodash', '4.17.11')) is None
+    cache.set(('npm', 'lodash', '4.17.11'), True)
+    cache.set(('npm', 'jquery', '3.6.4'), False)
+    assert cache.get(('npm', 'lodash', '4.17.11')) is True
+    assert cache.get(('npm', 'jquery', '3.6.4')) is False
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+
+def test_negative_ttl():
+    """Test that negative entries expire after the negative TTL."""
+    cache = PersistentCache('test', negative_ttl=60)
+    with mock.patch('f8a_report.cache_helper.time.time', return_value=1000):
+        cache.set(('npm', 'jquery', '3.6.4'), False)
+        cache.set(('npm', 'lodash', '4.17.11'), True)
+    with mock.patch('f8a_report.cache_helper.time.time', return_value=1100):
+        assert cache.get(('npm', 'jquery', '3.6.4')) is None
+        assert cache.get(('npm', 'lodash', '4.17.11')) is True
+
+
+@mock_s3
+def test_save_and_load():
+    """Test that the cache content survives a round trip through S3."""
+    boto3.resource('s3').create_bucket(Bucket=BUCKET)
+    s3 = S3Helper()
+    cache = PersistentCache('test', s3=s3)
+    cache.set(('npm', 'lodash', '4.17.11'), True)
+    cache.save()
+    assert not cache.dirty
+
+    cache = PersistentCache('test', s3=s3)
+    assert cache.get(('npm', 'lodash', '4.17.11')) is True
+
+
+def test_get_persistent_cache():
+    """Test that the helpers of the process share one instance of each cache."""
+    cache = get_persistent_cache('test-shared', ttl=60)
+    assert get_persistent_cache('test-shared', ttl=60) is cache
+    assert cache.ttl == 60
+    assert get_persistent_cache('test-other') is not cache
+    with pytest.raises(ValueError):
+        get_persistent_cache('test-shared', ttl=120)
+
+
+@mock_s3
+def test_load_failure_is_not_saved():
+    """Test that a cache that could not be loaded does not overwrite the stored one."""
+    boto3.resource('s3').create_bucket(Bucket=BUCKET)
+    s3 = S3Helper()
+    # A cache not stored yet is saved
+    cache = PersistentCache('test', s3=s3)
+    cache.set(('npm', 'lodash', '4.17.11'), True)
+    cache.save()
+    assert not cache.load_failed
+
+    # A truncated upload
+    boto3.resource('s3').Object(BUCKET, 'cache/test.json').put(Body=b'{"entries": [')
+    cache = PersistentCache('test', s3=s3)
+    cache.set(('npm', 'jquery', '3.6.4'), True)
+    cache.save()
+    assert cache.load_failed
+    assert boto3.resource('s3').Object(BUCKET, 'cache/test.json').get()['Body'].read() == \
+        b'{"entries": ['
@@ -1,8 +1,11 @@
 """Tests for classes from cve_report_helper module."""
 import pytest
 import json
+import time
 from unittest import mock
-from f8a_report.cve_helper import CVE
+from f8a_report.cve_helper import CVE, CVEReportProvider, GitHubRateLimiter, \
+    GitHubRateLimited, PRIORITY_INGESTION, PRIORITY_OPEN_COUNT
+from f8a_report.cache_helper import PersistentCache
 from datetime import datetime as dt
 from requests.exceptions import Timeout
 
@@ -23,7 +26,8 @@ def mock_github_get(*_args, **_kwargs):
             """Create a mock json response."""
             self.json_data = json_data
             self.status_code = status_code
-            self.headers = {'X-RateLimit-Remaining': 3, 'X - RateLimit - Reset': 5}
+            self.headers = {'X-RateLimit-Remaining': 3, 'X - RateLimit - Reset': 5,
+                            'ETag': 'W/"1"'}
 
         def json(self):
             """Get the mock json response."""
@@ -66,10 +70,7 @@ def mock_graph_post(*_args, **_kwargs):
             """Get the mock json response."""
             return self.json_data
 
-    with open('tests/data/graph_cve_data.json', 'r') as f:
-        graph_cve_response = json.loads(f.read())
-
-    return MockResponse(graph_cve_response, 200)
+    return MockResponse({'result': {'data': ['CVE-2017-1000116']}}, 200)
 
 
 @mock.patch('f8a_report.cve_helper.CVE.call_github_api')
@@ -95,6 +96,16 @@ def test_validate_cveids_in_graph(_mock1):
     assert ingested is not None
     assert len(ingested) == 1
 
+    # All the CVE ids are checked by a single query
+    _mock1.reset_mock()
+    ingested, missed = cve.validate_cveids_in_graph(
+        cve_ids=['CVE-2017-1000116', 'CVE-2018-0001'])
+    assert ingested == ['CVE-2017-1000116']
+    assert missed == ['CVE-2018-0001']
+    _mock1.assert_called_once()
+    assert _mock1.call_args[1]['json']['bindings'] == {
+        'cve_ids': ['CVE-2017-1000116', 'CVE-2018-0001']}
+
     # Test an invalid status-code 500 use-case
     _mock1.side_effect = mock_graph_post_error
     ingested, missed = cve.validate_cveids_in_graph(cve_ids=['CVE-2017-1000116'])
@@ -121,7 +132,7 @@ def test_get_fp_cves_count(_mock1):
         assert fp_cves_count is None
 
 
-@mock.patch('requests.get')
+@mock.patch('requests.Session.get')
 def test_call_github_api(_mock1):
     """Test call github api."""
     # Test valid response from github
@@ -142,6 +153,8 @@ def test_get_open_cves_count(_mock1):
     _mock1.return_value = github_api_response
     cve_stat = cve.get_open_cves_count(updated_on=dt.today().strftime('%Y-%m-%d'))
     assert cve_stat is not None
+    assert cve_stat['github_stats']['open_count'] == {
+        '2 days': 1, '7 days': 1, '30 days': 1, '365 days': 1}
 
 
 @mock.patch('f8a_report.cve_helper.CVE.get_open_cves_count', return_value=cve_stats)
@@ -153,3 +166,129 @@ def test_generate_cve_report(_mock1, _mock2, _mock3, _mock4):
     """Test CVE generat report."""
     cve_report = cve.generate_cve_report(dt.today().strftime('%Y-%m-%d'))
     assert cve_report is not None
+
+
+@mock.patch('f8a_report.cve_helper.CVE.generate_cve_report')
+def test_cve_report_provider(_mock1):
+    """Test that the CVE report of a day is generated only once."""
+    _mock1.side_effect = [None, {'ingestion': {}}]
+    provider = CVEReportProvider()
+    cache = PersistentCache('cve-reports')
+    # A failed report is not memoized
+    assert provider.get_report('2020-01-01', cache) is None
+    assert provider.get_report('2020-01-01', cache) == {'ingestion': {}}
+    assert provider.get_report('2020-01-01', cache) == {'ingestion': {}}
+    assert _mock1.call_count == 2
+    assert cache.get(('2020-01-01',)) == {'ingestion': {}}
+
+    # A retried run reuses the report stored by the previous one
+    _mock1.reset_mock()
+    assert CVEReportProvider().get_report('2020-01-01', cache) == {'ingestion': {}}
+    _mock1.assert_not_called()
+
+
+@mock.patch('requests.Session.get')
+def test_call_github_api_etag(_mock1):
+    """Test that an unchanged search is answered from the ETag cache."""
+    helper = CVE(PersistentCache('github-etags'))
+    _mock1.side_effect = mock_github_get
+    assert helper.call_github_api('+is:pr') == github_api_response
+    assert 'If-None-Match' not in _mock1.call_args[1]['headers']
+
+    # A conditional request does not take a token of the exhausted quota
+    _mock1.side_effect = None
+    _mock1.return_value = mock.Mock(status_code=304, headers={'X-RateLimit-Remaining': 3})
+    with mock.patch('f8a_report.cve_helper.github_rate_limiter.acquire', return_value=False):
+        assert helper.call_github_api('+is:pr') == github_api_response
+    assert _mock1.call_args[1]['headers']['If-None-Match'] == 'W/"1"'
+
+
+def test_github_rate_limiter():
+    """Test that the last tokens of the quota are kept for the important calls."""
+    limiter = GitHubRateLimiter()
+    assert limiter.acquire(PRIORITY_OPEN_COUNT)
+    limiter.update({'X-RateLimit-Remaining': '1',
+                    'X-RateLimit-Reset': str(int(time.time()) + 60)})
+    assert not limiter.acquire(PRIORITY_OPEN_COUNT)
+    assert limiter.acquire(PRIORITY_INGESTION)
+    assert not limiter.acquire(PRIORITY_INGESTION)
+    assert limiter.wait_time() > 0
+
+
+@mock.patch('requests.Session.get')
+@mock.patch('f8a_report.cve_helper.github_rate_limiter.acquire', return_value=False)
+def test_call_github_api_rate_limited(_mock1, _mock2):
+    """Test that a rate limited call fails at once instead of waiting."""
+    # A search without a cached ETag needs a token
+    with pytest.raises(GitHubRateLimited):
+        CVE(PersistentCache('github-etags')).call_github_api('')
+    _mock2.assert_not_called()
+
+
+@mock.patch('f8a_report.cve_helper.github_rate_limiter.wait_time', return_value=0)
+@mock.patch('f8a_report.cve_helper.CVE.generate_cve_report')
+def test_cve_report_provider_rate_limited(_mock1, _mock2):
+    """Test that a rate limited CVE report is filled in once the limit resets."""
+    _mock1.side_effect = [GitHubRateLimited(), {'ingestion': {}}]
+    provider = CVEReportProvider()
+    callback = mock.Mock()
+    assert provider.get_report('2020-01-01') is None
+    assert provider.when_ready('2020-01-01', callback)
+    assert not provider.when_ready('2020-01-02', callback)
+    provider.wait()
+    callback.assert_called_once_with({'ingestion': {}})
+    assert provider.get_report('2020-01-01') == {'ingestion': {}}
+    assert _mock1.call_count == 2
+
+
+@mock.patch('requests.Session.get')
+def test_call_github_api_rate_limit_response(_mock1):
+    """Test that a rate limited GitHub response is not reported as a failure."""
+    _mock1.return_value = mock.Mock(status_code=403, headers={
+        'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 60)})
+    with mock.patch('f8a_report.cve_helper.github_rate_limiter', GitHubRateLimiter()):
+        with pytest.raises(GitHubRateLimited):
+            cve.call_github_api('')
+        # The report is deferred instead of being given up
+        with pytest.raises(GitHubRateLimited):
+            cve.generate_cve_report(dt.today().strftime('%Y-%m-%d'))
+
+
+@mock.patch('f8a_report.cve_helper.CVE.validate_cveids_in_graph', return_value=([], []))
+@mock.patch('requests.Session.get')
+def test_open_count_rate_limited(_mock1, _mock2):
+    """Test that only the open counts held back by the rate limit are filled in later."""
+    _mock1.return_value = mock.Mock(status_code=200, headers={},
+                                    json=mock.Mock(return_value=github_api_response))
+    quota = {'open_count': False}
+
+    def acquire(priority=PRIORITY_INGESTION):
+        return priority < PRIORITY_OPEN_COUNT or quota['open_count']
+
+    def reset_quota():
+        quota['open_count'] = True
+        return 0
+
+    with mock.patch('f8a_report.cve_helper.github_rate_limiter.acquire', side_effect=acquire), \
+            mock.patch('f8a_report.cve_helper.github_rate_limiter.wait_time',
+                       side_effect=reset_quota):
+        helper = CVE()
+        assert helper.get_open_cves_count(updated_on='2020-01-01') == {
+            'github_stats': {'open_count': {}}}
+        assert helper.open_counts_deferred
+
+        provider = CVEReportProvider()
+        cache = PersistentCache('cve-reports')
+        callback = mock.Mock()
+        # The rest of the report is returned at once, but it is not stored incomplete
+        report = provider.get_report('2020-01-01', cache)
+        assert report['github_stats'] == {'open_count': {}, 'false_positives': 1}
+        assert report['ingestion'] == {'ingested': [], 'missed': []}
+        assert cache.get(('2020-01-01',)) is None
+        assert provider.when_ready('2020-01-01', callback)
+        provider.wait()
+    report = callback.call_args[0][0]
+    assert report['github_stats']['open_count'] == {
+        '2 days': 1, '7 days': 1, '30 days': 1, '365 days': 1}
+    assert cache.get(('2020-01-01',)) == report
+    assert provider.get_report('2020-01-01', cache) == report
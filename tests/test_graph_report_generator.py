@@ -2,7 +2,10 @@
 
 from f8a_report.graph_report_generator import execute_gremlin_dsl, \
     generate_report_for_unknown_epvs, generate_report_for_latest_version, \
-    generate_report_for_cves, find_ingested_epv, rectify_latest_version
+    generate_report_for_cves, find_ingested_epv, BatchSizer, \
+    batch_query_executor, get_batch_sizes, fetch_latest_versions, Deadline, LatestVersionSync, \
+    find_cves_in_graph
+from f8a_report.cache_helper import PersistentCache
 from unittest import mock
 from datetime import date
 
@@ -145,8 +148,8 @@ def test_generate_report_for_unknown_epvs(mocker):
                     "version": "2.40.1"
                 }]
     out = generate_report_for_unknown_epvs(epv_list)
-    assert out['maven@DELIM@io.vertx:vertx-web@DELIM@3.6.3'] == "true"
-    assert out['npm@DELIM@lodash@DELIM@2.40.1'] == "false"
+    assert out[('maven', 'io.vertx:vertx-web', '3.6.3')] == "true"
+    assert out[('npm', 'lodash', '2.40.1')] == "false"
 
 
 @mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
@@ -166,12 +169,12 @@ def test_generate_report_for_latest_version(mocker):
                     "name": "test-hooks"
                 }]
     out = generate_report_for_latest_version(epv_list, date(1947, 8, 15))
-    assert out['maven@DELIM@io.vertx:vertx-web']['known_latest_version'] == "3.6.3"
-    assert out['npm@DELIM@lodash']['known_latest_version'] == "2.39.2"
-    assert out['maven@DELIM@io.vertx:vertx-web']['actual_latest_version'] == "3.6.3"
-    assert out['npm@DELIM@lodash']['actual_latest_version'] is not None
-    assert out['npm@DELIM@lodash']['actual_latest_version'] != "2.39.2"
-    assert out['npm@DELIM@test-hooks']['actual_latest_version'] == "1.1.1"
+    assert out[('maven', 'io.vertx:vertx-web')]['known_latest_version'] == "3.6.3"
+    assert out[('npm', 'lodash')]['known_latest_version'] == "2.39.2"
+    assert out[('maven', 'io.vertx:vertx-web')]['actual_latest_version'] == "3.6.3"
+    assert out[('npm', 'lodash')]['actual_latest_version'] is not None
+    assert out[('npm', 'lodash')]['actual_latest_version'] != "2.39.2"
+    assert out[('npm', 'test-hooks')]['actual_latest_version'] == "1.1.1"
 
 
 @mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
@@ -190,14 +193,26 @@ def test_generate_report_for_cves(mocker):
         }
     }
     out = generate_report_for_cves(cve_data)
-    assert out['CVE-2013-4310@DELIM@org.apache.struts:struts2-core@DELIM@2.0.5'] == \
+    assert out[('CVE-2013-4310', 'org.apache.struts:struts2-core', '2.0.5')] == \
         "Found"
-    assert out['CVE-2013-4310@DELIM@org.apache.struts:struts2-core@DELIM@2.0.6'] == \
+    assert out[('CVE-2013-4310', 'org.apache.struts:struts2-core', '2.0.6')] == \
         "Not Found"
-    assert out['CVE-2013-4310@DELIM@org.apache.struts:struts2-core@DELIM@2.0.7'] == \
+    assert out[('CVE-2013-4310', 'org.apache.struts:struts2-core', '2.0.7')] == \
         "False Positive"
 
 
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_find_cves_in_graph(_mock1):
+    """Test that the CVE ids are checked in chunks and failed chunks are left unchecked."""
+    _mock1.side_effect = [{'result': {'data': ['CVE-1', 'CVE-2']}}, None]
+    present, unchecked = find_cves_in_graph(['CVE-1', 'CVE-2', 'CVE-1', 'CVE-3'], chunk_size=2)
+    assert present == {'CVE-1', 'CVE-2'}
+    assert unchecked == ['CVE-3']
+    assert _mock1.call_count == 2
+    assert _mock1.call_args_list[0][0][0]['bindings'] == {'cve_ids': ['CVE-1', 'CVE-2']}
+    assert 'within(cve_ids)' in _mock1.call_args_list[0][0][0]['gremlin']
+
+
 @mock.patch('requests.Session.post', side_effect="")
 def test_execute_gremlin_dsl(mocker):
     """Test the function execute_gremlin_dsl."""
@@ -234,24 +249,196 @@ def test_find_ingested_epv(mocker):
     assert out['report']['serve-static 1.7.1'] == 'Ingested'
 
 
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_generate_report_for_unknown_epvs_cached(mocker):
+    """Test that cached EPVs are not queried against the graph."""
+    mocker.return_value = mock_response()
+    epv_cache = PersistentCache('graph-epvs')
+    epv_cache.set(('npm', 'lodash', '2.40.1'), True)
+    epv_list = [{
+                    "ecosystem": "maven",
+                    "name": "io.vertx:vertx-web",
+                    "version": "3.6.3"
+                },
+                {
+                    "ecosystem": "npm",
+                    "name": "lodash",
+                    "version": "2.40.1"
+                }]
+    out = generate_report_for_unknown_epvs(epv_list, epv_cache)
+    assert out[('maven', 'io.vertx:vertx-web', '3.6.3')] == "true"
+    assert out[('npm', 'lodash', '2.40.1')] == "true"
+    assert "lodash" not in mocker.call_args[0][0]['gremlin']
+    assert epv_cache.get(('maven', 'io.vertx:vertx-web', '3.6.3')) is True
+
+    mocker.reset_mock()
+    generate_report_for_unknown_epvs(epv_list, epv_cache)
+    mocker.assert_not_called()
+
+
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_generate_report_for_unknown_epvs_duplicates(mocker):
+    """Test that an EPV analysed several times is queried only once."""
+    mocker.return_value = mock_response()
+    epv = {
+        "ecosystem": "maven",
+        "name": "io.vertx:vertx-web",
+        "version": "3.6.3"
+    }
+    out = generate_report_for_unknown_epvs([epv, dict(epv), dict(epv)])
+    assert out[('maven', 'io.vertx:vertx-web', '3.6.3')] == "true"
+    assert mocker.call_args[0][0]['gremlin'].count("io.vertx:vertx-web") == 1
+
+
+@mock.patch("f8a_report.graph_report_generator.get_latest_versions_for_ep")
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_generate_report_for_latest_version_duplicates(mocker, upstream_mocker):
+    """Test that the latest version is looked up once per package."""
+    mocker.return_value = mock_response1()
+    upstream_mocker.return_value = "2.40.1"
+    epv_list = [{
+                    "ecosystem": "npm",
+                    "name": "lodash",
+                    "version": version
+                } for version in ("2.39.1", "2.39.2", "2.39.2")]
+    out = generate_report_for_latest_version(epv_list, date(1947, 8, 15))
+    assert out[('npm', 'lodash')]['actual_latest_version'] == "2.40.1"
+    assert mocker.call_args[0][0]['gremlin'].count("lodash") == 1
+    assert upstream_mocker.call_count == 1
+
+
+def test_batch_sizer():
+    """Test that the batch size adapts to latency and errors within bounds."""
+    sizer = BatchSizer(size=20, min_size=5, max_size=30, step=5, target_seconds=1)
+    sizer.record(20, 0.5, True)
+    assert sizer.size == 25
+    sizer.record(10, 0.5, True)
+    assert sizer.size == 25
+    sizer.record(25, 0.5, True)
+    sizer.record(30, 0.5, True)
+    assert sizer.size == 30
+    sizer.record(30, 2, True)
+    assert sizer.size == 15
+    sizer.record(15, 0.5, False)
+    sizer.record(7, 0.5, False)
+    assert sizer.size == 5
+    assert sizer.errors == 2
+
+
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl", return_value=None)
+def test_batch_query_executor_shrinks_on_errors(mocker):
+    """Test that failing batches shrink the batch size of their query type."""
+    query_str = "g.V().has('pecosystem', '{arg0}').has('pname', '{arg1}');"
+    args = [{"0": "npm", "1": "pkg{}".format(i)} for i in range(50)]
+    assert batch_query_executor(query_str, args, 'test-errors') == []
+    sizes = get_batch_sizes()['test-errors']
+    assert sizes['batch_size'] < 25
+    assert sizes['errors'] == mocker.call_count
+
+    # The statistics of a later report only count its own batches
+    before = get_batch_sizes()
+    batch_query_executor(query_str, args[:1], 'test-errors')
+    assert get_batch_sizes(since=before) == {'test-errors': {
+        'batch_size': max(5, sizes['batch_size'] // 2), 'batches': 1, 'errors': 1}}
+
+
+@mock.patch("f8a_report.graph_report_generator.get_latest_versions_for_ep")
+def test_fetch_latest_versions(mocker):
+    """Test concurrent upstream lookups going through the version cache."""
+    mocker.return_value = "1.0.0"
+    version_cache = PersistentCache('upstream-latest-versions')
+    version_cache.set(('npm', 'lodash'), "4.17.11")
+    packages = [('npm', 'lodash'), ('npm', 'jquery'), ('maven', 'io.vertx:vertx-web'),
+                ('pypi', 'six'), ('npm', 'jquery')]
+    out = fetch_latest_versions(packages, version_cache)
+    assert out == {('npm', 'lodash'): "4.17.11",
+                   ('npm', 'jquery'): "1.0.0",
+                   ('maven', 'io.vertx:vertx-web'): "1.0.0",
+                   ('pypi', 'six'): "1.0.0"}
+    assert mocker.call_count == 3
+    assert version_cache.get(('pypi', 'six')) == "1.0.0"
+
+    mocker.side_effect = ValueError
+    out = fetch_latest_versions([('npm', 'broken')], version_cache)
+    assert out == {('npm', 'broken'): ""}
+    assert version_cache.get(('npm', 'broken')) is None
+
+
+@mock.patch("f8a_report.graph_report_generator.get_latest_versions_for_ep", return_value="")
+def test_fetch_latest_versions_negative(mocker):
+    """Test that packages without an upstream version are cached for the negative TTL."""
+    version_cache = PersistentCache('upstream-latest-versions', ttl=86400, negative_ttl=60)
+    with mock.patch('f8a_report.cache_helper.time.time', return_value=1000):
+        assert fetch_latest_versions([('npm', 'missing')], version_cache) == {
+            ('npm', 'missing'): ""}
+        assert fetch_latest_versions([('npm', 'missing')], version_cache) == {
+            ('npm', 'missing'): ""}
+    assert mocker.call_count == 1
+    with mock.patch('f8a_report.cache_helper.time.time', return_value=1100):
+        fetch_latest_versions([('npm', 'missing')], version_cache)
+    assert mocker.call_count == 2
+
+
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_generate_report_for_unknown_epvs_deadline(mocker):
+    """Test that EPVs are left unchecked once the deadline expires or a batch fails."""
+    epv_cache = PersistentCache('graph-epvs')
+    epv_list = [{
+                    "ecosystem": "npm",
+                    "name": "lodash",
+                    "version": "2.40.1"
+                }]
+    out = generate_report_for_unknown_epvs(epv_list, epv_cache, Deadline(0))
+    assert out[('npm', 'lodash', '2.40.1')] == "unchecked"
+    mocker.assert_not_called()
+
+    mocker.return_value = None
+    out = generate_report_for_unknown_epvs(epv_list, epv_cache, Deadline(60))
+    assert out[('npm', 'lodash', '2.40.1')] == "unchecked"
+    assert epv_cache.get(('npm', 'lodash', '2.40.1')) is None
+
+
+@mock.patch("f8a_report.graph_report_generator.execute_gremlin_dsl")
+def test_generate_report_for_latest_version_deadline(mocker):
+    """Test that packages are flagged unchecked once the deadline expires."""
+    epv_list = [{
+                    "ecosystem": "npm",
+                    "name": "lodash"
+                }]
+    out = generate_report_for_latest_version(epv_list, date(1947, 8, 15), deadline=Deadline(0))
+    assert out[('npm', 'lodash')]['unchecked'] is True
+    mocker.assert_not_called()
+
+
 @mock.patch('requests.post', side_effect=mock_post_with_payload_check)
-def test_rectify_latest_version(mocker):
-    """Test the function rectify_latest_version."""
-    mocker.return_value = ""
-    lst = [
-        {
-            "package": "io.vertx:vertx-web",
-            "actual_latest_version": "3.7.9"
-        }
-    ]
-    resp = rectify_latest_version(lst, "maven")
-    assert resp == "Success"
+def test_latest_version_sync(mocker):
+    """Test that sync submissions are deduplicated, chunked and awaited."""
+    sync = LatestVersionSync(chunk_size=2, workers=2)
+    sync.submit({'express 4.0.0': 2, 'npm 6.2.0': 2, 'serve-static 1.7.1': 2}, "npm", True)
+    sync.submit({'express 4.0.1': 1}, "npm", True)
+    sync.submit([{"package": "io.vertx:vertx-web", "actual_latest_version": "3.7.9"}], "maven")
+    assert sync.wait() == {'npm': {'synced': 3, 'failed': 0},
+                           'maven': {'synced': 1, 'failed': 0}}
+    assert mocker.call_count == 3
+    posted = [dep['name'] for call in mocker.call_args_list for dep in call[1]['json']]
+    assert sorted(posted) == ['express', 'io.vertx:vertx-web', 'npm', 'serve-static']
+
+    mocker.side_effect = ValueError
+    sync.submit({'lodash 4.17.11': 1}, "npm", True)
+    assert sync.wait() == {'npm': {'synced': 0, 'failed': 1}}
 
 
 @mock.patch('requests.post', side_effect=mock_post_with_payload_check)
-def test_rectify_latest_version2(mocker):
-    """Test the function rectify_latest_version."""
-    mocker.return_value = ""
-    lst = {'express 4.0.0': 2, 'npm 6.2.0': 2, 'serve-static 1.7.1': 2}
-    resp = rectify_latest_version(lst, "npm", True)
-    assert resp == "Success"
+def test_latest_version_sync_window(mocker):
+    """Test that stack packages synced within the window are not resent."""
+    sync_cache = PersistentCache('latest-version-syncs', ttl=3600)
+    sync_cache.set(('npm', 'express'), True)
+    sync = LatestVersionSync()
+    sync.submit({'express 4.0.0': 2, 'npm 6.2.0': 2}, "npm", True, sync_cache)
+    assert sync.wait() == {'npm': {'synced': 1, 'failed': 0}}
+    assert mocker.call_args[1]['json'] == [{"ecosystem": "npm", "name": "npm"}]
+    assert sync_cache.get(('npm', 'npm')) is True
+
+    sync = LatestVersionSync()
+    sync.submit({'express 4.0.0': 2, 'npm 6.2.0': 2}, "npm", True, sync_cache)
+    assert sync.wait() == {}
@@ -0,0 +1,168 @@
+"""Tests for classes from ingestion_report_helper module."""
+
+from f8a_report.ingestion_report_helper import IngestionReportHelper
+from f8a_report.cache_helper import PersistentCache
+from unittest import mock
+import json
+import pytest
+
+unknown_json = {
+    ("npm", "lodash", "4.17.11"): "true",
+    ("npm", "jquery", "3.3.1"): "false",
+    ("npm", "jquery", "3.6.4"): "false",
+    ("maven", "dep1", "4.17.11"): "true",
+    ("maven", "dep2", "3.3.1"): "false",
+    ("pypi", "dep2", "3.3.2"): "false",
+    ("pypi", "dep1", "4.17.11"): "true",
+    ("pypi", "dep2", "3.3.1"): "false",
+    ("maven", "dep2", "3.6.4"): "false"
+}
+
+latest_json = {
+    ("npm", "jquery"): {
+        "ecosystem": "npm",
+        "name": "jquery",
+        "known_latest_version": "3.6.3",
+        "actual_latest_version": "3.6.4",
+        "latest_non_cve_version": "3.6.4"
+    },
+    ("npm", "lodash"): {
+        "ecosystem": "npm",
+        "name": "lodash",
+        "known_latest_version": "4.17.11",
+        "actual_latest_version": "4.17.11"
+    },
+    ("pypi", "dep2"): {
+        "ecosystem": "pypi",
+        "name": "dep2",
+        "known_latest_version": "3.3.1",
+        "actual_latest_version": "3.3.2",
+        "latest_non_cve_version": "3.3.2"
+    },
+    ("pypi", "dep1"): {
+        "ecosystem": "pypi",
+        "name": "dep1",
+        "known_latest_version": "4.17.11",
+        "actual_latest_version": "4.17.11"
+    },
+    ("maven", "dep2"): {
+        "ecosystem": "maven",
+        "name": "dep2",
+        "known_latest_version": "3.3.1",
+        "actual_latest_version": "3.6.4"
+    },
+    ("maven", "dep1"): {
+        "ecosystem": "maven",
+        "name": "dep1",
+        "known_latest_version": "4.17.11",
+        "actual_latest_version": "4.17.11"
+    }
+
+}
+
+with open('tests/data/ingestiondata.json', 'r') as f:
+    ingestiondata = json.load(f)
+
+UNKNOWN_EPVS = 'f8a_report.ingestion_report_helper.generate_report_for_unknown_epvs'
+LATEST_VERSION = 'f8a_report.ingestion_report_helper.generate_report_for_latest_version'
+
+
+@pytest.fixture
+def helper():
+    """Ingestion report helper storing its reports in a mocked S3."""
+    return IngestionReportHelper(mock.Mock(), PersistentCache('graph-epvs'),
+                                 PersistentCache('upstream-latest-versions'))
+
+
+@mock.patch(UNKNOWN_EPVS, return_value=unknown_json)
+@mock.patch(LATEST_VERSION, return_value=latest_json)
+def test_normalize_ingestion_data(_mock1, _mock2, helper):
+    """Test the success scenario of the function normalize_worker_data."""
+    resp = helper.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata, 'daily')
+    assert resp is not None
+    # The latest version EPVs are checked in the same single graph pass
+    _mock2.assert_called_once()
+    assert {'ecosystem': 'npm', 'name': 'jquery', 'version': '3.6.4'} in _mock2.call_args[0][0]
+    assert resp['ingestion_details']['npm']['jquery']['latest_node_in_graph'] == 'false'
+    assert resp['ingestion_summary']['missing_latest_node']['npm'] == [
+        {'package': 'jquery', 'version': '3.6.4'}]
+
+
+@mock.patch(UNKNOWN_EPVS,
+            return_value={**unknown_json, ("npm", "jquery", "3.3.1"): "unchecked"})
+@mock.patch(LATEST_VERSION, return_value=latest_json)
+def test_normalize_ingestion_data_unchecked(_mock1, _mock2, helper):
+    """Test that EPVs left unchecked by the graph time budget are reported as such."""
+    resp = helper.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata, 'daily')
+    assert resp['ingestion_details']['npm']['jquery']['3.3.1']['synced_to_graph'] == 'unchecked'
+    assert resp['ingestion_summary']['unchecked']['npm'] == [
+        {'ecosystem': 'npm', 'name': 'jquery', 'version': '3.3.1'}]
+    assert resp['ingestion_summary']['stats']['npm']['unchecked'] == 1
+    assert resp['ingestion_summary']['stats']['npm']['ingested_in_graph'] == 1
+
+
+@mock.patch(UNKNOWN_EPVS, return_value=unknown_json)
+@mock.patch(LATEST_VERSION, return_value=latest_json)
+def test_fill_unchecked_ingestion_data(_mock1, _mock2, helper):
+    """Test that a follow-up run checks only the unchecked EPVs of a saved report."""
+    with mock.patch(UNKNOWN_EPVS,
+                    return_value={**unknown_json, ("npm", "jquery", "3.3.1"): "unchecked"}):
+        partial = helper.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata,
+                                                  'daily')
+    helper.s3.read_json_object.return_value = partial
+    resp = helper.fill_unchecked_ingestion_data('2018-10-18')
+    assert _mock1.call_args[0][0] == [{'ecosystem': 'npm', 'name': 'jquery', 'version': '3.3.1'}]
+    assert resp['ingestion_details']['npm']['jquery']['3.3.1']['synced_to_graph'] == 'false'
+    assert resp['ingestion_summary']['unchecked'] == {'npm': []}
+    stats = resp['ingestion_summary']['stats']['npm']
+    assert stats['unchecked'] == 0
+    assert stats['ingested_in_graph'] == 1
+    assert stats['not_ingested_in_graph'] == 1
+    assert stats['incorrect_latest_versions'] == 1
+    # The latest node checked again is not reported twice
+    assert resp['ingestion_summary']['missing_latest_node']['npm'] == [
+        {'package': 'jquery', 'version': '3.6.4'}]
+
+
+@mock.patch(UNKNOWN_EPVS, return_value=unknown_json)
+@mock.patch(LATEST_VERSION, return_value=latest_json)
+def test_fill_unchecked_latest_node(_mock1, _mock2, helper):
+    """Test that a latest node left unchecked is looked up by the follow-up run."""
+    with mock.patch(UNKNOWN_EPVS,
+                    return_value={**unknown_json, ("npm", "jquery", "3.6.4"): "unchecked"}):
+        partial = helper.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata,
+                                                  'daily')
+    assert partial['ingestion_summary']['unchecked']['npm'] == [
+        {'ecosystem': 'npm', 'name': 'jquery', 'version': '3.6.4', 'latest_node': True}]
+    assert 'npm' not in partial['ingestion_summary']['missing_latest_node']
+    stats = dict(partial['ingestion_summary']['stats']['npm'])
+
+    helper.s3.read_json_object.return_value = partial
+    resp = helper.fill_unchecked_ingestion_data('2018-10-18')
+    # Only the latest node is looked up, the stats of the EPVs are left as they were
+    assert _mock1.call_args[0][0] == []
+    assert {'ecosystem': 'npm', 'name': 'jquery', 'version': '3.6.4'} in _mock2.call_args[0][0]
+    assert resp['ingestion_details']['npm']['jquery']['latest_node_in_graph'] == 'false'
+    assert resp['ingestion_summary']['missing_latest_node']['npm'] == [
+        {'package': 'jquery', 'version': '3.6.4'}]
+    assert resp['ingestion_summary']['unchecked'] == {}
+    assert resp['ingestion_summary']['stats']['npm'] == stats
+
+
+@mock.patch(UNKNOWN_EPVS, return_value=unknown_json)
+@mock.patch(LATEST_VERSION, return_value=latest_json)
+def test_fill_unchecked_recounts_stats(_mock1, _mock2, helper):
+    """Test that the unchecked stats follow the EPVs still unchecked after the merge."""
+    with mock.patch(UNKNOWN_EPVS,
+                    return_value={**unknown_json, ("npm", "jquery", "3.3.1"): "unchecked",
+                                  ("pypi", "dep2", "3.3.2"): "unchecked"}):
+        partial = helper.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata,
+                                                  'daily')
+    # The re-check has no stats for pypi, its stale unchecked count must not survive
+    partial['ingestion_summary']['stats']['pypi']['unchecked'] = 1
+
+    helper.s3.read_json_object.return_value = partial
+    resp = helper.fill_unchecked_ingestion_data('2018-10-18')
+    assert resp['ingestion_summary']['unchecked'] == {'npm': []}
+    assert resp['ingestion_summary']['stats']['npm']['unchecked'] == 0
+    assert resp['ingestion_summary']['stats']['pypi']['unchecked'] == 0
@@ -5,6 +5,7 @@ from unittest import mock
 import os
 from freezegun import freeze_time
 import datetime
+import pytest
 from f8a_report.report_helper import ReportHelper
 
 
@@ -29,14 +30,16 @@ class MockReportHelper(ReportHelper):
         """Mock re-train."""
         return args, kwargs
 
+    ingestion_helper = mock.Mock()
+
     @staticmethod
     def cleanup_db_tables(*args, **kwargs):
         """Mock cleanup_db_tables."""
         return args, kwargs
 
     @staticmethod
-    def retrieve_stack_analyses_content(*args, **kwargs):
-        """Mock retrieve_stack_analyses_content."""
+    def retrieve_stack_analyses_sample(*args, **kwargs):
+        """Mock retrieve_stack_analyses_sample."""
         return True, args, kwargs
 
 
@@ -50,13 +53,15 @@ def test_time_to_generate_monthly_report():
 
 
 @mock.patch('f8a_report.main.StackReportBuilder.get_report')
+@mock.patch('f8a_report.report_helper.IngestionReportHelper.fill_unchecked_ingestion_data',
+            return_value=None)
 @mock.patch('f8a_report.main.ReportHelper.get_report', return_value=[{}, True])
 @mock.patch('f8a_report.main.ReportHelper.re_train', return_value=True)
-@mock.patch('f8a_report.main.ReportHelper.retrieve_stack_analyses_content', return_value=True)
+@mock.patch('f8a_report.main.ReportHelper.retrieve_stack_analyses_sample', return_value=True)
 @mock.patch('f8a_report.main.manifest_interface', return_value=True)
-def test_main(_mock1, _mock2, _mock3, _mock4, _mock5):
+def test_main(_mock1, _mock2, _mock3, _mock4, _mock5, _mock6):
     """Test the function main."""
-    _mock5.return_value = ("response_v2", "ingestion_results_v2")
+    _mock6.return_value = ("response_v2", "ingestion_results_v2")
     resp = main()
     assert (isinstance(resp, dict))
 
@@ -71,5 +76,19 @@ def test_environment(_mock1, _mock2, _mock3):
     resp = main()
     assert datetime.datetime.today().weekday() == 0
     assert (isinstance(resp, tuple))
-    assert _mock2().retrieve_stack_analyses_content()[0] is True
+    assert _mock2().retrieve_stack_analyses_sample()[0] is True
     assert os.environ.get('GENERATE_MANIFESTS') in ['True', 'False']
+
+
+@mock.patch('f8a_report.main.cve_report_provider')
+@mock.patch('f8a_report.main.latest_version_sync')
+@mock.patch('f8a_report.main.StackReportBuilder.get_report', side_effect=RuntimeError)
+@mock.patch('f8a_report.main.ReportHelper', return_value=MockReportHelper)
+@freeze_time("2020-04-01")
+def test_main_waits_on_failure(_mock1, _mock2, _mock_sync, _mock_provider):
+    """Test that the background syncs and CVE reports are awaited when a report fails."""
+    _mock_sync.wait.side_effect = RuntimeError
+    with pytest.raises(RuntimeError):
+        main()
+    _mock_sync.wait.assert_called_once()
+    _mock_provider.wait.assert_called_once()
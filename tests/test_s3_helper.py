@@ -1,8 +1,11 @@
 """Tests for classes from s3_helper module."""
 
-from f8a_report.s3_helper import S3Helper
+from f8a_report.s3_helper import S3Helper, S3_MAX_POOL_CONNECTIONS
 from moto import mock_s3
+import pytest
 import boto3
+import json
+from unittest import mock
 import os
 
 BUCKET = os.environ.get('MANIFESTS_BUCKET')
@@ -20,6 +23,10 @@ def test_s3_client():
     S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
     s3 = S3.s3_client(BUCKET)
     assert s3
+    # The resource is shared by the helpers using the same credentials
+    assert S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET).s3_client(
+        BUCKET) is s3
+    assert s3.meta.client.meta.config.max_pool_connections == S3_MAX_POOL_CONNECTIONS
 
 
 @mock_s3
@@ -31,6 +38,81 @@ def test_store_json_content():
     S3.store_json_content({"keyA": "valueB"}, BUCKET, 'dummy.json')
 
 
+@mock_s3
+def test_store_json_content_compressed():
+    """Test that compressed objects are stored gzip encoded and read back transparently."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    content = {"stacks_details": [{"stack": [1, 2, 3]}] * 100}
+    S3.store_json_content(content, BUCKET, 'compressed.json', compress=True)
+    S3.store_json_content(content, BUCKET, 'plain.json', compress=False)
+    compressed = s3.Object(BUCKET, 'compressed.json').get()
+    assert 'gzip' in compressed['ContentEncoding'].split(',')
+    assert compressed['ContentLength'] < s3.Object(BUCKET, 'plain.json').content_length
+    assert S3.read_json_object(BUCKET, 'compressed.json') == content
+    assert S3.read_json_object(BUCKET, 'plain.json') == content
+
+
+@mock_s3
+@mock.patch('f8a_report.s3_helper.S3_MULTIPART_PART_SIZE', 5 * 1024 * 1024)
+def test_store_json_stream():
+    """Test that large reports are uploaded in parts and small ones in a single put."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    content = {"stacks_details": [{"stack": "x" * 1000, "id": i} for i in range(12000)]}
+    S3.store_json_stream(content, BUCKET, 'large.json')
+    # A multipart upload gets an ETag with the number of parts
+    assert s3.Object(BUCKET, 'large.json').e_tag.endswith('-3"')
+    assert S3.read_json_object(BUCKET, 'large.json') == content
+
+    S3.store_json_stream({"keyA": "valueB"}, BUCKET, 'small.json')
+    assert s3.Object(BUCKET, 'small.json').get()['Body'].read() == \
+        json.dumps({"keyA": "valueB"}, indent=2).encode('utf-8')
+
+    S3.store_json_stream(content, BUCKET, 'compressed.json', compress=True)
+    assert S3.read_json_object(BUCKET, 'compressed.json') == content
+
+
+@mock_s3
+def test_put_many_get_many():
+    """Test the bulk transfers and their per object status."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    objects = [(BUCKET, 'obj{}.json'.format(i), {'i': i}) for i in range(20)]
+    stored = S3.put_many(objects + [('dummy', 'obj.json', {})])
+    assert stored.pop(('dummy', 'obj.json')) is False
+    assert all(stored.values()) and len(stored) == 20
+
+    read = S3.get_many([(BUCKET, 'obj3.json'), (BUCKET, 'missing.json')])
+    assert read == {(BUCKET, 'obj3.json'): {'i': 3}, (BUCKET, 'missing.json'): None}
+
+
+@mock_s3
+def test_read_json_object_cached(tmpdir):
+    """Test that cached objects are decoded once and revalidated with their ETag."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    S3.store_json_content({'v': 1}, BUCKET, 'cached.json')
+    with mock.patch('f8a_report.s3_helper.S3_CACHE_DIR', str(tmpdir)):
+        first = S3.read_json_object(BUCKET, 'cached.json', cache=True)
+        assert first == {'v': 1}
+        # An unchanged object is shared between the helpers
+        other = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+        assert other.read_json_object(BUCKET, 'cached.json', cache=True) is first
+
+        # The copy on disk is used once the process forgets the object
+        with mock.patch('f8a_report.s3_helper._cached_objects', {}):
+            assert S3.read_json_object(BUCKET, 'cached.json', cache=True) == {'v': 1}
+            assert len(tmpdir.listdir()) == 2
+
+        S3.store_json_content({'v': 2}, BUCKET, 'cached.json')
+        assert S3.read_json_object(BUCKET, 'cached.json', cache=True) == {'v': 2}
+
+
 @mock_s3
 def test_read_json_object():
     """Test to validate read_json method."""
@@ -44,6 +126,38 @@ def test_read_json_object():
     assert data is None
 
 
+@pytest.fixture(params=['ijson', None])
+def json_parser(request):
+    """Run the streaming reads with ijson and with the fallback parsing the whole object."""
+    parser = pytest.importorskip(request.param) if request.param else None
+    with mock.patch('f8a_report.s3_helper.ijson', parser):
+        yield parser
+
+
+@mock_s3
+def test_read_json_path(json_parser):
+    """Test the streaming reads of plain and compressed objects."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    content = {'stacks_summary': {'npm': {'total': 2.5}},
+               'stacks_details': [{'stack': [i]} for i in range(50)]}
+    for compress in (False, True):
+        S3.store_json_content(content, BUCKET, 'report.json', compress=compress)
+        assert S3.read_json_path(BUCKET, 'report.json', 'stacks_summary.npm') == {'total': 2.5}
+        assert S3.read_json_path(BUCKET, 'report.json', 'stacks_details') == \
+            content['stacks_details']
+        assert S3.read_json_path(BUCKET, 'report.json', 'missing') is None
+    assert S3.read_json_path(BUCKET, 'missing.json', 'stacks_summary') is None
+
+    if json_parser is not None:
+        # Floats are not returned as Decimal and only the path is built
+        with mock.patch.object(json_parser, 'items', wraps=json_parser.items) as items:
+            value = S3.read_json_path(BUCKET, 'report.json', 'stacks_summary.npm.total')
+        assert isinstance(value, float)
+        assert items.call_args[0][1] == 'stacks_summary.npm.total'
+
+
 @mock_s3
 def test_list_objects():
     """Test to validate list_object method."""
@@ -57,6 +171,29 @@ def test_list_objects():
     assert len(data['objects']) == 0
 
 
+@mock_s3
+def test_iter_objects():
+    """Test that only the reports between the dates are listed."""
+    s3 = boto3.resource('s3')
+    s3.create_bucket(Bucket=BUCKET)
+    S3 = S3Helper(aws_access_key_id=AWS_KEY, aws_secret_access_key=AWS_SECRET)
+    for day in range(1, 10):
+        S3.store_json_content({}, BUCKET, 'dev/daily/2020-01-0{d}.json'.format(d=day))
+    S3.store_json_content({}, BUCKET, 'dev/monthly/2020-01.json')
+    # A folder whose name starts with the frequency is not listed
+    S3.store_json_content({}, BUCKET, 'dev/daily-v2/2020-01-04.json')
+    with mock.patch('botocore.client.BaseClient._make_api_call',
+                    wraps=S3.s3_client(BUCKET).meta.client._make_api_call) as api_call:
+        keys = S3.iter_objects(BUCKET, 'daily', start='2020-01-03', end='2020-01-05')
+        assert list(keys) == ['dev/daily/2020-01-0{d}.json'.format(d=day) for day in (3, 4, 5)]
+        assert api_call.call_args[0][1]['Prefix'] == 'dev/daily/'
+        assert api_call.call_args[0][1]['StartAfter'] == 'dev/daily/2020-01-03'
+    assert len(list(S3.iter_objects(BUCKET, 'daily', start='2020-01-08'))) == 2
+    assert len(S3.list_objects(BUCKET, 'daily', end='2020-01-02')['objects']) == 2
+    assert S3.list_objects(BUCKET, 'monthly', start='2020-01', end='2020-01')['objects'] == [
+        'dev/monthly/2020-01.json']
+
+
 @mock_s3
 def test_store_file_object():
     """Test to validate list_object method."""
@@ -1,10 +1,18 @@
 """Tests for classes from sentry_report_helper module."""
 
 from f8a_report.sentry_report_helper import SentryReportHelper
+import pytest
 import responses
 
 sobj = SentryReportHelper()
 
+
+@pytest.fixture(autouse=True)
+def clear_events_cache():
+    """Start every test with an empty Sentry events cache."""
+    sobj.events_cache.entries = {}
+
+
 sentry_issues_res = [{
     "lastSeen": "2019-05-15T06:50:10Z",
     "id": "12666",
@@ -110,7 +118,14 @@ def test_retrieve_sentry_logs_success():
                                                 "stacktrace": "File /src/data_importer.py,"
                                                 " Line 228, Function import_epv_http, "
                                                 "Statement  report = _import_keys_from_s3_http()"
-                                                              " || "}]}}}
+                                                              " || ",
+                                                "frames": [{
+                                                    "file": "/src/data_importer.py",
+                                                    "line": 228,
+                                                    "function": "import_epv_http",
+                                                    "statement":
+                                                        " report = _import_keys_from_s3_http()"
+                                                }]}]}}}
     assert (res == expected_output)
 
 
@@ -136,5 +151,83 @@ def test_retrieve_sentry_logs_nostacktrace():
                                                 "2019-05-15T06:50:10Z",
                                                 "bayesian-data-importer-52-fgp4f":
                                                     "TypeError: must be str, not list",
-                                                "stacktrace": "Not Available"}]}}}
+                                                "stacktrace": "Not Available",
+                                                "frames": []}]}}}
     assert (res == expected_output)
+
+
+@responses.activate
+def test_retrieve_sentry_logs_events_in_issue_order():
+    """Test that the events are collected in issue order and failed issues are skipped."""
+    issues = [dict(sentry_issues_res[0], id=issue_id) for issue_id in ('1', '2', '3')]
+    responses.add(responses.GET, 'https://sentry.devshift.net/api/0/projects/'
+                                 'sentry/fabric8-analytics-production/issues/'
+                                 '?statsPeriod=24h', json=issues, status=200)
+    for issue_id in ('1', '3'):
+        responses.add(responses.GET, 'https://sentry.devshift.net/api/0/issues/'
+                                     '{}/events/latest/'.format(issue_id),
+                      json=sentry_tags_res, status=200)
+    responses.add(responses.GET, 'https://sentry.devshift.net/api/0/issues/'
+                                 '2/events/latest/', json={}, status=500)
+    res = sobj.retrieve_sentry_logs('2019-05-14', '2019-05-15')
+    report = res['error_report']['bayesian-data-importer']
+    assert report['total_errors'] == 2
+    assert [error['id'] for error in report['errors']] == ['1', '3']
+
+
+@responses.activate
+def test_retrieve_sentry_logs_pages():
+    """Test that the issues of all the pages are reported."""
+    issues_url = 'https://sentry.devshift.net/api/0/projects/sentry/' \
+                 'fabric8-analytics-production/issues/'
+    responses.add(responses.GET, issues_url + '?statsPeriod=24h',
+                  json=[dict(sentry_issues_res[0], id='1')], status=200,
+                  headers={'Link': '<{url}?statsPeriod=24h&cursor=1:0:0>; rel="previous"; '
+                                   'results="false"; cursor="1:0:1", '
+                                   '<{url}?statsPeriod=24h&cursor=1:100:0>; rel="next"; '
+                                   'results="true"; cursor="1:100:0"'.format(url=issues_url)})
+    responses.add(responses.GET, issues_url + '?statsPeriod=24h&cursor=1:100:0',
+                  json=[dict(sentry_issues_res[0], id='2')], status=200,
+                  headers={'Link': '<{url}?statsPeriod=24h&cursor=1:200:0>; rel="next"; '
+                                   'results="false"; cursor="1:200:0"'.format(url=issues_url)})
+    for issue_id in ('1', '2'):
+        responses.add(responses.GET, 'https://sentry.devshift.net/api/0/issues/'
+                                     '{}/events/latest/'.format(issue_id),
+                      json=sentry_tags_res, status=200)
+    res = sobj.retrieve_sentry_logs('2019-05-14', '2019-05-15')
+    report = res['error_report']['bayesian-data-importer']
+    assert [error['id'] for error in report['errors']] == ['1', '2']
+    assert len(responses.calls) == 4
+
+
+@responses.activate
+def test_retrieve_sentry_logs_unchanged_issues():
+    """Test that the events are retrieved again only for the issues seen again."""
+    responses.add(responses.GET, 'https://sentry.devshift.net/api/0/issues/'
+                                 '12666/events/latest/', json=sentry_tags_res, status=200)
+    sobj.normalize_sentry_data('2019-05-14', '2019-05-15', sentry_issues_res)
+    res = sobj.normalize_sentry_data('2019-05-14', '2019-05-15', sentry_issues_res)
+    assert res['error_report']['bayesian-data-importer']['total_errors'] == 1
+    assert len(responses.calls) == 1
+
+    seen_again = [dict(sentry_issues_res[0], lastSeen='2019-05-16T06:50:10Z')]
+    sobj.normalize_sentry_data('2019-05-14', '2019-05-15', seen_again)
+    assert len(responses.calls) == 2
+
+
+def test_extract_frames():
+    """Test that the frames of all the exceptions are extracted."""
+    exception = sentry_tags_res['entries'][1]
+    chained = {
+        "type": "exception",
+        "data": {"values": [{"stacktrace": {"frames": [
+            {"function": "main", "lineNo": 3, "filename": "/src/app.py",
+             "context": [[2, "import x"], [4, "x()"]]}]}}]}
+    }
+    frames = sobj.extract_frames([sentry_tags_res['entries'][0], exception, chained])
+    assert [frame['function'] for frame in frames] == ['import_epv_http', 'main']
+    assert frames[1]['statement'] is None
+    assert sobj.render_stacktrace(frames) == \
+        'File /src/data_importer.py, Line 228, Function import_epv_http, ' \
+        'Statement  report = _import_keys_from_s3_http() || ' \
+        'File /src/app.py, Line 3, Function main || '
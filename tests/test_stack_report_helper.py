@@ -31,60 +31,6 @@ mock_false = {
     "ingestion_details": {}
 }
 
-unknown_json = {
-    "npm@DELIM@lodash@DELIM@4.17.11": "true",
-    "npm@DELIM@jquery@DELIM@3.3.1": "false",
-    "npm@DELIM@jquery@DELIM@3.6.4": "false",
-    "maven@DELIM@dep1@DELIM@4.17.11": "true",
-    "maven@DELIM@dep2@DELIM@3.3.1": "false",
-    "pypi@DELIM@dep2@DELIM@3.3.2": "false",
-    "pypi@DELIM@dep1@DELIM@4.17.11": "true",
-    "pypi@DELIM@dep2@DELIM@3.3.1": "false",
-    "maven@DELIM@dep2@DELIM@3.6.4": "false"
-}
-
-latest_json = {
-    "npm@DELIM@jquery": {
-        "ecosystem": "npm",
-        "name": "jquery",
-        "known_latest_version": "3.6.3",
-        "actual_latest_version": "3.6.4",
-        "latest_non_cve_version": "3.6.4"
-    },
-    "npm@DELIM@lodash": {
-        "ecosystem": "npm",
-        "name": "lodash",
-        "known_latest_version": "4.17.11",
-        "actual_latest_version": "4.17.11"
-    },
-    "pypi@DELIM@dep2": {
-        "ecosystem": "pypi",
-        "name": "dep2",
-        "known_latest_version": "3.3.1",
-        "actual_latest_version": "3.3.2",
-        "latest_non_cve_version": "3.3.2"
-    },
-    "pypi@DELIM@dep1": {
-        "ecosystem": "pypi",
-        "name": "dep1",
-        "known_latest_version": "4.17.11",
-        "actual_latest_version": "4.17.11"
-    },
-    "maven@DELIM@dep2": {
-        "ecosystem": "maven",
-        "name": "dep2",
-        "known_latest_version": "3.3.1",
-        "actual_latest_version": "3.6.4"
-    },
-    "maven@DELIM@dep1": {
-        "ecosystem": "maven",
-        "name": "dep1",
-        "known_latest_version": "4.17.11",
-        "actual_latest_version": "4.17.11"
-    }
-
-}
-
 with open('tests/data/stacks_with_recurrence_count.json', 'r') as f:
     unique_stacks_with_recurrence_count = json.load(f)
 
@@ -100,10 +46,6 @@ with open('tests/data/stackdict.json', 'r') as f:
 with open('tests/data/manifest.json', 'r') as f:
     manifest = json.load(f)
 
-with open('tests/data/ingestiondata.json', 'r') as f:
-    ingestiondata = f.read()
-    ingestiondata = json.loads(ingestiondata)
-
 
 def test_validate_and_process_date_success():
     """Test the success scenario of the function validate_and_process_date."""
@@ -384,6 +326,21 @@ def test_normalize_worker_data(_mock1, _mock2, _mock3):
     assert resp[2]['stacks_summary']['unique_unknown_licenses_with_frequency']['mpl-2.0'] == 2
 
 
+@mock.patch('f8a_report.report_helper.ReportHelper.save_result', return_value=True)
+@mock.patch('f8a_report.report_helper.cve_report_provider')
+@mock.patch('f8a_report.report_helper.UnknownDepsReportHelper.get_current_ingestion_status',
+            return_value={'npm': {}, 'maven': {}, 'pypi': {}})
+def test_normalize_worker_data_retrain_rate_limited(_mock1, _mock_provider, _mock_save):
+    """Test that the stacks collected for retraining are not saved as a report later."""
+    _mock_provider.get_report.return_value = None
+    resp = r.normalize_worker_data('2018-10-10', '2018-10-18',
+                                   stackdata, 'stack_aggregator_v2', 'weekly', retrain=True)
+
+    assert resp is not None
+    _mock_provider.when_ready.assert_not_called()
+    _mock_save.assert_not_called()
+
+
 @mock.patch('f8a_report.report_helper.S3Helper.store_json_content', return_value=True)
 @mock.patch('f8a_report.report_helper.UnknownDepsReportHelper.get_current_ingestion_status',
             return_value={'npm': {}, 'maven': {}, 'pypi': {}})
@@ -430,15 +387,6 @@ def test_retrieve_worker_results():
     assert res == {}
 
 
-@mock.patch('f8a_report.report_helper.S3Helper.store_json_content', return_value=True)
-@mock.patch('f8a_report.report_helper.generate_report_for_unknown_epvs', return_value=unknown_json)
-@mock.patch('f8a_report.report_helper.generate_report_for_latest_version', return_value=latest_json)
-def test_normalize_ingestion_data(_mock1, _mock2, _mock3):
-    """Test the success scenario of the function normalize_worker_data."""
-    resp = r.normalize_ingestion_data('2018-10-10', '2018-10-18', ingestiondata, 'daily')
-    assert resp is not None
-
-
 def test_get_trending():
     """Test top trending."""
     test_dict = {'a': 20, 'b': 2, 'c': 1, 'd': 100}
@@ -456,6 +404,20 @@ def test_re_train(_mock1, _mock2, _mock3):
     assert resp is None
 
 
+@mock.patch('f8a_report.report_helper.S3Helper.store_json_content')
+@mock.patch('f8a_report.report_helper.S3Helper.store_json_stream')
+def test_save_result(_mock_stream, _mock_content):
+    """Test that the sidecar is stored only along with its report."""
+    _mock_stream.return_value = True
+    r.save_result('daily', '2019-09-26', {'stacks_summary': {}})
+    assert _mock_content.call_args[1]['obj_key'] == 'unknown-deps/daily/2019-09-26.json'
+
+    _mock_content.reset_mock()
+    _mock_stream.return_value = False
+    r.save_result('daily', '2019-09-26', {'stacks_summary': {}})
+    _mock_content.assert_not_called()
+
+
 @mock.patch('f8a_report.report_helper.ReportHelper.save_result', return_value=True)
 def test_create_venus_report(_mock1):
     """Test success create_venus_report."""
@@ -469,3 +431,38 @@ def test_collate_and_retrain(_mock1, _mock2):
     """Test success create_venus_report."""
     resp = r.collate_and_retrain(unique_stacks_with_recurrence_count, 'weekly')
     assert resp is None
+
+
+def test_retrieve_stack_analyses_sample():
+    """Test that the requests are sampled per ecosystem in Postgres."""
+    rows = [({'manifest': [{'ecosystem': 'npm'}]},)]
+    with mock.patch.object(r, 'cursor') as cursor:
+        cursor.fetchall.return_value = rows
+        assert r.retrieve_stack_analyses_sample('2020-01-01', '2020-01-08', 3) == rows
+        query, params = cursor.execute.call_args[0]
+        assert params == ('2020-01-01', '2020-01-08', ('npm', 'maven', 'pypi'), 3)
+    with pytest.raises(ValueError):
+        r.retrieve_stack_analyses_sample('foobar', '2020-01-08', 3)
+
+
+@mock.patch('f8a_report.report_helper.MANIFEST_SQL_SAMPLING', False)
+def test_retrieve_stack_analyses_sample_reservoir():
+    """Test the streamed reservoir sampling of the requests."""
+    requests = [('npm', {'id': i}) for i in range(10)] + [('pypi', {'id': 10})]
+    with mock.patch.object(r, 'conn') as conn:
+        conn.cursor.return_value.__enter__.return_value.__iter__.return_value = iter(requests)
+        sample = r.retrieve_stack_analyses_sample('2020-01-01', '2020-01-08', 3)
+        assert conn.cursor.call_args[1]['name']
+    assert len(sample) == 4
+    assert ({'id': 10},) in sample
+    assert len({row[0]['id'] for row in sample}) == 4
+
+
+def test_report_helpers_share_caches():
+    """Test that the v1 and v2 report helpers save their entries in the same caches."""
+    other = ReportHelper()
+    assert other.sync_cache is r.sync_cache
+    for cache in ('epv_cache', 'latest_version_cache', 'cve_report_cache',
+                  'github_etag_cache'):
+        assert getattr(other, cache) is getattr(r, cache)
+    assert other.sentry_helper.events_cache is r.sentry_helper.events_cache
@@ -45,3 +45,39 @@ def test_get_current_ingestion_status(_mock1, _mock2):
     assert result['npm']['ingested_dependencies'] == 0
     assert result['npm']['report']['lodash 2.40.1'] == 'Unknown'
     assert result['npm']['report']['serve-static 1.7.1'] == 'Unknown'
+
+
+def test_build_sidecar():
+    """Test that only the unknown deps of the report are kept."""
+    report = {'stacks_summary': {
+        'npm': {'total_stack_requests_count': 2,
+                'unique_unknown_dependencies_with_frequency': {'lodash 2.1': 1}},
+        'maven': {'total_stack_requests_count': 0},
+        'total_stack_requests_count': 2}}
+    sidecar = uobj.build_sidecar(report)
+    assert sidecar == {'stacks_summary': {
+        'npm': {'unique_unknown_dependencies_with_frequency': {'lodash 2.1': 1}},
+        'maven': {'unique_unknown_dependencies_with_frequency': {}}}}
+    assert uobj.get_unknown_list(sidecar) == uobj.get_unknown_list(report)
+
+
+@mock.patch('f8a_report.unknown_deps_report_helper.S3Helper.read_json_object',
+            return_value=result)
+def test_get_past_unknown_deps_sidecar(_mock1):
+    """Test that the unknown deps are read from the sidecar object."""
+    unknown_deps = uobj.get_past_unknown_deps()
+    assert len(unknown_deps['npm']) == 1
+    _mock1.assert_called_once()
+    assert _mock1.call_args[1]['obj_key'].startswith('unknown-deps/daily/')
+
+
+@mock.patch('f8a_report.unknown_deps_report_helper.S3Helper.read_json_path',
+            return_value=result['stacks_summary'])
+@mock.patch('f8a_report.unknown_deps_report_helper.S3Helper.read_json_object',
+            return_value=None)
+def test_get_past_unknown_deps_fallback(_mock1, _mock2):
+    """Test the fallback to the summary of the full report when the sidecar is missing."""
+    unknown_deps = uobj.get_past_unknown_deps()
+    assert len(unknown_deps['npm']) == 1
+    assert _mock2.call_args[1]['obj_key'].startswith('daily/')
+    assert _mock2.call_args[1]['path'] == 'stacks_summary'
@@ -105,10 +105,26 @@ class TestStackReportBuilder(TestCase):
             result[0]['stack_aggregator_v2']['stacks_summary']['total_stack_requests_count'], 10)
 
     @patch('f8a_report.v2.report_generator.S3Helper.store_json_content')
-    def test_save_result(self, _mock1):
+    @patch('f8a_report.v2.report_generator.S3Helper.store_json_stream')
+    def test_save_result(self, _mock1, _mock2):
         """Test save to s3."""
-        result = self.ReportBuilder.save_worker_result_to_s3('daily', 'report_name', 'content')
+        content = {'stacks_summary': {'npm': {
+            'total_stack_requests_count': 2,
+            'unique_unknown_dependencies_with_frequency': {'lodash 2.1': 1}}}}
+        result = self.ReportBuilder.save_worker_result_to_s3('daily', 'report_name', content)
         self.assertTrue(result)
+        _mock2.assert_called_once()
+        self.assertEqual(_mock2.call_args[1]['obj_key'], 'unknown-deps/v2/daily/report_name.json')
+        self.assertEqual(_mock2.call_args[1]['content'], {'stacks_summary': {'npm': {
+            'unique_unknown_dependencies_with_frequency': {'lodash 2.1': 1}}}})
+
+    @patch('f8a_report.v2.report_generator.S3Helper.store_json_content')
+    @patch('f8a_report.v2.report_generator.S3Helper.store_json_stream', return_value=False)
+    def test_save_result_failed(self, _mock1, _mock2):
+        """Test that no sidecar is stored for a report that could not be saved."""
+        result = self.ReportBuilder.save_worker_result_to_s3('daily', 'report_name', {})
+        self.assertFalse(result)
+        _mock2.assert_not_called()
 
     def test_collate_vulnerabilites(self):
         """Test Collate Vulnerability method."""
@@ -126,3 +142,18 @@ class TestStackReportBuilder(TestCase):
         self.assertListEqual(
             result['private_vulnerabilities']['cve_list'],
             analysed_dependencies['private_vulnerabilities'])
+
+    @patch('f8a_report.v2.report_generator.StackReportBuilder.save_worker_result_to_s3')
+    @patch('f8a_report.v2.report_generator.cve_report_provider')
+    @patch('f8a_report.v2.report_generator.UnknownDepsReportHelperV2.get_current_ingestion_status')
+    def test_normalize_worker_data_retrain_rate_limited(self, _mock1, _mock_provider, _mock_save):
+        """Test that the stacks collected for retraining are not saved as a report later."""
+        _mock1.return_value = {'npm': {}, 'maven': {}, 'pypi': {}}
+        _mock_provider.get_report.return_value = None
+        self.ReportBuilder.start_date = '2020-01-01'
+        self.ReportBuilder.end_date = '2020-01-08'
+        result = self.ReportBuilder.normalize_worker_data(json.dumps(self.stack_analyses_v2),
+                                                          True, 'weekly')
+        self.assertIn('npm', result)
+        _mock_provider.when_ready.assert_not_called()
+        _mock_save.assert_not_called()